@@ -19,5 +19,13 @@ cd app
 
 python3 manage.py migrate
 
-celery -A oj_backend.backend.celery_tasks worker --loglevel=info &
-gunicorn oj_backend.wsgi:application -b 0.0.0.0:8080 --workers 4 --worker-connections 65535
+# Metrics of all gunicorn and celery processes are merged from this directory.
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/ojbn_metrics}
+rm -rf ${PROMETHEUS_MULTIPROC_DIR} && mkdir -p ${PROMETHEUS_MULTIPROC_DIR}
+
+celery -A oj_backend.backend.celery_tasks worker --loglevel=info -Q celery,git_provision,course_provision &
+if [ "${OJBN_SERVER_MODE}" = "asgi" ]; then
+    gunicorn oj_backend.asgi:application -b 0.0.0.0:8080 --workers ${OJBN_WORKERS:-4} -k uvicorn.workers.UvicornWorker
+else
+    gunicorn oj_backend.wsgi:application -b 0.0.0.0:8080 --workers ${OJBN_WORKERS:-4}
+fi
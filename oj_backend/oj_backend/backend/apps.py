@@ -2,4 +2,5 @@ from django.apps import AppConfig
 
 
 class BackendConfig(AppConfig):
-    name = 'backend'
+    name = 'oj_backend.backend'
+    label = 'backend'
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Async variants of the I/O bound views, routed instead of their sync
+counterparts when the server runs in ASGI mode (`OJBN_SERVER_MODE=asgi`).
+
+Redis is accessed with the shared `redis.asyncio` client, and the queue
+streams of a process share one pubsub connection through `QueueUpdateHub`; the
+ORM is synchronous only, so every database access is offloaded to a thread
+with `sync_to_async`.
+"""
+
+import time
+import asyncio
+import logging
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.views import View
+from django.http import JsonResponse, StreamingHttpResponse
+try:
+    from django.utils import simplejson
+except:
+    import simplejson
+
+from oj_backend.backend.roles import get_course_role
+from oj_backend.backend.judge_queue import ingest_submission, parse_page, async_read_pending, resolve_nicknames, format_pending, async_queue_position, queue_update_channel
+from oj_backend.backend.scoreboard import get_ranking, project_instructor, project_public
+from oj_backend.settings import OJ_SUBMISSION_TOKEN
+from oj_backend.backend.redis_client import get_redis, get_async_redis
+
+backend_logger = logging.getLogger('backend.main')
+
+
+class QueueUpdateHub:
+
+    '''
+    Fans the queue update notifications out to the open streams of this
+    process over one pubsub connection, so that open streams do not hold a
+    connection of the pool each.
+    '''
+
+    def __init__(self):
+        self.pubsub = None
+        self.reader = None
+        self.listeners = {}
+
+    async def subscribe(self, channel):
+        '''
+        Returns an `asyncio.Event` set on every update of `channel`. Pass it
+        to `unsubscribe` when done.
+        '''
+        if self.pubsub is None:
+            self.pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+        event = asyncio.Event()
+        if channel in self.listeners:
+            self.listeners[channel].add(event)
+        else:
+            self.listeners[channel] = {event}
+            await self.pubsub.subscribe(channel)
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self.read())
+        return event
+
+    async def unsubscribe(self, channel, event):
+        listeners = self.listeners.get(channel)
+        if listeners is None:
+            return
+        listeners.discard(event)
+        if not listeners:
+            del self.listeners[channel]
+            await self.pubsub.unsubscribe(channel)
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except aioredis.ConnectionError as e:
+                # The pubsub reconnects and subscribes again on the next read.
+                backend_logger.error(
+                    'Queue update subscription lost: {}'.format(e))
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            for event in self.listeners.get(channel, ()):
+                event.set()
+
+
+queue_update_hub = QueueUpdateHub()
+
+
+def course_membership(request, course_uid):
+    '''
+    Returns `(user_uid, is_instructor, is_student)` of the request's user in
+    the course, with `user_uid` being `None` for anonymous users. Raises
+    `Http404` if the course does not exist.
+    '''
+    if not request.user.is_authenticated:
+        return None, False, False
+    this_role = get_course_role(request, course_uid)
+    return request.user.uid, this_role.is_instructor, this_role.is_student
+
+
+class asyncPendingAssignment(View):
+    '''
+    `/course/<str:course_id>/assignment/<str:assignment_id>/queue/`
+    '''
+    page_size = 100
+    max_page_size = 500
+
+    async def get(self, request, course_id, assignment_id):
+        user_uid, is_instr, is_student = await sync_to_async(course_membership)(request, course_id)
+        if user_uid is None:
+            return JsonResponse(data={}, status=401)
+        if not (is_instr or is_student):
+            return JsonResponse(data={}, status=403)
+        try:
+            offset, limit = parse_page(
+                request.GET, self.page_size, self.max_page_size)
+        except ValueError:
+            return JsonResponse(data={'cause': 'Bad request'}, status=400)
+        redis_server = get_async_redis()
+        async with redis_server.pipeline(transaction=False) as pipe:
+            pipe.zrange(assignment_id, offset, offset + limit - 1)
+            pipe.zcard(assignment_id)
+            all_pending, total = await pipe.execute()
+        all_pending = await async_read_pending(redis_server, assignment_id, all_pending)
+        nicknames = await sync_to_async(resolve_nicknames)(all_pending)
+        response = JsonResponse(format_pending(
+            all_pending, nicknames), status=200, safe=False)
+        response['X-Total-Count'] = total
+        return response
+
+
+class asyncPendingAssignmentStream(View):
+    '''
+    `/course/<str:course_id>/assignment/<str:assignment_id>/queue/stream`
+
+    Server-sent events carrying the position of the user's first pending
+    submission. An event is sent whenever the position changes; the queue is
+    re-checked on every update published by the backend and at least every
+    `poll_interval` seconds, which covers the pops done by `oj-scheduler`.
+    The stream ends after `max_duration` seconds and the client reconnects.
+    Only routed in ASGI mode, where an open stream costs a coroutine instead
+    of a worker.
+    '''
+    poll_interval = 5
+    keepalive_interval = 15
+    max_duration = 300
+
+    async def get(self, request, course_id, assignment_id):
+        user_uid, is_instr, is_student = await sync_to_async(course_membership)(request, course_id)
+        if user_uid is None:
+            return JsonResponse(data={}, status=401)
+        if not (is_instr or is_student):
+            return JsonResponse(data={}, status=403)
+        response = StreamingHttpResponse(self.stream(
+            assignment_id, user_uid), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream(self, assignment_id, user_uid):
+        redis_server = get_async_redis()
+        channel = queue_update_channel(assignment_id)
+        updated = await queue_update_hub.subscribe(channel)
+        try:
+            started = last_sent = time.time()
+            last_state = None
+            while time.time() - started < self.max_duration:
+                position, total = await async_queue_position(
+                    redis_server, assignment_id, user_uid)
+                if (position, total) != last_state:
+                    last_state = (position, total)
+                    last_sent = time.time()
+                    yield 'data: {}\n\n'.format(simplejson.dumps({'position': position, 'total': total}))
+                elif time.time() - last_sent >= self.keepalive_interval:
+                    last_sent = time.time()
+                    yield ': keepalive\n\n'
+                try:
+                    await asyncio.wait_for(updated.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                # Coalesce a burst of updates into one check.
+                updated.clear()
+        finally:
+            await queue_update_hub.unsubscribe(channel, updated)
+
+
+class asyncInternalSubmissionInterface(View):
+    '''
+    `/internal/subbmission/`
+    '''
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Authenticated by token, not by session.
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    async def post(self, request, *args, **kwargs):
+        auth_token = request.META.get("HTTP_AUTHORIZATION", None)
+        if auth_token != OJ_SUBMISSION_TOKEN:
+            remote = request.META.get(
+                'HTTP_X_FORWARDED_FOR', request.META.get('REMOTE_ADDR', None))
+            backend_logger.error('Submission interface recieved an unauthorized submission. Token: {}; From {}; Payload: {}'.format(
+                auth_token, remote, request.body))
+            return JsonResponse(status=401, data={'cause': 'Invalid token.'})
+        # The middlewares post JSON or a form, both of which the sync view's
+        # parsers take.
+        if request.content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+            data = request.POST.dict()
+        else:
+            try:
+                data = simplejson.loads(request.body)
+            except ValueError:
+                return JsonResponse(data={'cause': 'Malformed request'}, status=400)
+            if not isinstance(data, dict):
+                return JsonResponse(data={'cause': 'Malformed request'}, status=400)
+        this_redis = get_redis()
+        try:
+            await sync_to_async(ingest_submission)(this_redis, data)
+        except KeyError:
+            return JsonResponse(data={'cause': 'Missing parameter in request'}, status=400)
+        return JsonResponse(data, status=201, safe=False)
+
+
+class asyncAssignmentScoreboardDetail(View):
+    '''
+    `/course/<str:course_id>/assignment/<str:assignment_id>/scores/`
+    '''
+
+    async def get(self, request, course_id, assignment_id):
+        user_uid, is_instr, _ = await sync_to_async(course_membership)(request, course_id)
+        if not is_instr:
+            return JsonResponse(data={'detail': 'You do not have permission to perform this action.'}, status=403)
+        ranking = await sync_to_async(get_ranking)(course_id, assignment_id)
+        return JsonResponse(project_instructor(ranking), safe=False)
+
+
+class asyncAssignmentScoreboardDetail4Student(View):
+    '''
+    `/student/<str:student_id>/course/<str:course_id>/assignment/<str:assignment_id>/scores/`
+    '''
+
+    async def get(self, request, student_id, course_id, assignment_id):
+        ranking = await sync_to_async(get_ranking)(course_id, assignment_id)
+        return JsonResponse(project_public(ranking), safe=False)
@@ -1,17 +1,321 @@
 from celery import Celery
+from celery.signals import task_prerun, task_postrun
 import os
+import logging
+import requests
+from datetime import datetime, timezone
+from uuid import UUID
 from oj_backend.backend.middleware_connector import *
+from oj_backend.backend.metrics import task_started, task_finished
+from oj_backend.backend.redis_client import get_redis, get_pipeline
+
+celery_logger = logging.getLogger('backend.main')
 
 celery_app = Celery('demo', broker='redis://{}:{}/{}'.format(
     os.environ['OJBN_REDIS_HOST'], os.environ['OJBN_REDIS_PORT'], os.environ['OJBN_REDIS_DB']))
 
-@celery_app.task
-def MWCourseAddRepoDelay(*args, **kwargs):
-    print("Add MWCourseAddRepo job:"+str(args)+str(kwargs))
-    MWCourseAddRepo(*args, **kwargs)
+# Number of repos provisioned by one `MWCourseAddReposDelay` task.
+MW_REPO_CHUNK_SIZE = int(os.environ.get('OJBN_MW_REPO_CHUNK_SIZE', 50))
+# Tasks talking to the git server run on their own queue, rate limited per
+# worker, so that a bulk enrolment could not overwhelm the git server.
+MW_TASK_QUEUE = 'git_provision'
+# Course creation has its own queue, so that it does not wait behind the
+# repos of a bulk enrolment.
+COURSE_PROVISION_QUEUE = 'course_provision'
+MW_TASK_RATE_LIMIT = os.environ.get('OJBN_MW_TASK_RATE_LIMIT', '30/m')
+MW_TASK_MAX_RETRIES = 5
+MW_TASK_RETRY_BACKOFF = 5
+# How long an enqueued repo creation blocks an identical one.
+MW_REPO_DEDUP_TTL = 24 * 60 * 60
+# How long the repos that could not be created are listed.
+MW_REPO_FAILURE_TTL = 7 * 24 * 60 * 60
+# How long the progress of a bulk enrolment job is kept.
+ENROL_JOB_TTL = 24 * 60 * 60
+# How long the ready state of a course is kept after it was last read. The
+# pending and failed states are kept until they change.
+COURSE_PROVISION_TTL = 7 * 24 * 60 * 60
+COURSE_PROVISION_PENDING = 'pending'
+COURSE_PROVISION_READY = 'ready'
+COURSE_PROVISION_FAILED = 'failed'
+# A course without a state that can not be taken as ready; it is provisioned
+# again, which is idempotent.
+COURSE_PROVISION_UNKNOWN = 'unknown'
+# Courses created before the provisioning state was kept have none.
+COURSE_PROVISION_SINCE = datetime(2026, 10, 18, tzinfo=timezone.utc)
+# Offset of the uuid1 epoch, 1582-10-15, from the unix epoch in 100ns.
+UUID1_EPOCH_OFFSET = 0x01b21dd213814000
+
+task_prerun.connect(task_started)
+task_postrun.connect(task_finished)
+
+celery_app.conf.task_routes = {
+    # Exact names are matched before patterns.
+    'oj_backend.backend.celery_tasks.MWCourseProvisionDelay': {'queue': COURSE_PROVISION_QUEUE},
+    'oj_backend.backend.celery_tasks.MWCourse*': {'queue': MW_TASK_QUEUE},
+}
+
+def retry_countdown(retries):
+    return MW_TASK_RETRY_BACKOFF * (2 ** retries)
+
+
+def get_repo_name(owner_email, repo_name=None):
+    if repo_name:
+        return repo_name
+    if isinstance(owner_email, list):
+        return 'group_' + "_".join(user.split('@')[0]for user in owner_email).lower()
+    return owner_email.split('@')[0].lower()
+
+
+def repo_idempotency_key(course_uid, assignment_uid, owner_email, repo_name=None):
+    # The uids are given dashed or not by different callers.
+    return 'mw_repo:{}:{}:{}'.format(UUID(str(course_uid)).hex, UUID(str(assignment_uid)).hex,
+                                     get_repo_name(owner_email, repo_name))
+
+
+def forget_repo(course_uid, assignment_uid, owner_email, repo_name=None):
+    '''
+    Allows the repo to be enqueued again.
+    '''
+    get_redis().delete(
+        repo_idempotency_key(course_uid, assignment_uid, owner_email, repo_name))
+
+
+def repo_failures_key(course_uid):
+    return 'mw_repo_failures:{}'.format(UUID(str(course_uid)).hex)
+
+
+def _repo_failure_field(repo):
+    return '{}:{}'.format(repo['assignment_uid'], get_repo_name(repo['owner_email'], repo.get('repo_name')))
+
+
+def record_repo_results(succeeded, failed):
+    '''
+    Lists the repos of `failed`, `(repo, cause)` pairs, under their course,
+    and unlists the repos of `succeeded`.
+    '''
+    pipe = get_pipeline()
+    for repo in succeeded:
+        pipe.hdel(repo_failures_key(repo['course_uid']), _repo_failure_field(repo))
+    for repo, cause in failed:
+        key = repo_failures_key(repo['course_uid'])
+        pipe.hset(key, _repo_failure_field(repo), cause)
+        pipe.expire(key, MW_REPO_FAILURE_TTL)
+    pipe.execute()
+
+
+def get_repo_failures(course_uid):
+    '''
+    Returns the repos of a course that could not be created in the last
+    `MW_REPO_FAILURE_TTL`, as a list of `{'assignment_uid', 'repo', 'cause'}`.
+    '''
+    failures = []
+    for field, cause in get_redis().hgetall(repo_failures_key(course_uid)).items():
+        assignment_uid, repo = field.decode().split(':', 1)
+        failures.append({'assignment_uid': assignment_uid,
+                         'repo': repo, 'cause': cause.decode()})
+    return failures
+
+
+@celery_app.task(bind=True, max_retries=MW_TASK_MAX_RETRIES, rate_limit=MW_TASK_RATE_LIMIT)
+def MWCourseAddRepoDelay(self, *args, **kwargs):
+    celery_logger.info('Add MWCourseAddRepo job: {} {}'.format(args, kwargs))
+    try:
+        MWCourseAddRepo(*args, **kwargs)
+    except MWUpdateError as e:
+        celery_logger.error('MWCourseAddRepo rejected: {}'.format(e))
+    except MiddlewareError as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=retry_countdown(self.request.retries))
+        celery_logger.error('MWCourseAddRepo gave up: {}'.format(e))
+
+
+@celery_app.task(bind=True, max_retries=MW_TASK_MAX_RETRIES, rate_limit=MW_TASK_RATE_LIMIT)
+def MWCourseDelRepoDelay(self, *args):
+    celery_logger.info('Add MWCourseDelRepo job: {}'.format(args))
+    try:
+        MWCourseDelRepo(*args)
+    except MWUpdateError as e:
+        celery_logger.error('MWCourseDelRepo rejected: {}'.format(e))
+    except MiddlewareError as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=retry_countdown(self.request.retries))
+        celery_logger.error('MWCourseDelRepo gave up: {}'.format(e))
+        return
+    # The repo could be created again if the student is enrolled again.
+    forget_repo(*args)
+
+
+@celery_app.task(bind=True, max_retries=MW_TASK_MAX_RETRIES, rate_limit=MW_TASK_RATE_LIMIT)
+def MWCourseAddReposDelay(self, repos):
+    celery_logger.info('Add MWCourseAddRepos job: {} repos'.format(len(repos)))
+    result = MWCourseAddRepos(repos)
+    if result.unreachable and self.request.retries < self.max_retries:
+        # Only the repos that did not reach the git server are retried.
+        rejected = [(repo, cause) for repo, cause in result.failed
+                    if repo not in result.unreachable]
+        for repo, cause in rejected:
+            celery_logger.error('MWCourseAddRepos rejected for {}: {}'.format(repo, cause))
+            forget_repo(repo['course_uid'], repo['assignment_uid'],
+                        repo['owner_email'], repo.get('repo_name'))
+        record_repo_results(result.succeeded, rejected)
+        raise self.retry(args=[result.unreachable], countdown=retry_countdown(self.request.retries))
+    for repo, cause in result.failed:
+        celery_logger.error('MWCourseAddRepos failed for {}: {}'.format(repo, cause))
+        forget_repo(repo['course_uid'], repo['assignment_uid'],
+                    repo['owner_email'], repo.get('repo_name'))
+    record_repo_results(result.succeeded, result.failed)
+    return {'succeeded': len(result.succeeded), 'failed': [[repo, cause] for repo, cause in result.failed]}
+
+
+def repo_for(course_uid, assignment, owner_email, owner_uid):
+    '''
+    Returns the `MWCourseAddRepo` arguments for a personal repo.
+    '''
+    return {'course_uid': str(course_uid), 'assignment_uid': str(assignment.uid), 'owner_email': owner_email,
+            'ddl': str(assignment.deadline.date()), 'owner_uid': simplejson.dumps([str(owner_uid)])}
+
+
+def provision_repos(repos):
+    '''
+    Enqueues the creation of `repos` in chunks of `MW_REPO_CHUNK_SIZE`. Repos
+    already enqueued or created within `MW_REPO_DEDUP_TTL` are skipped. If a
+    chunk can not be enqueued, the repos not enqueued yet are forgotten
+    before the error is raised.
+    '''
+    keys = [repo_idempotency_key(repo['course_uid'], repo['assignment_uid'], repo['owner_email'], repo.get('repo_name'))
+            for repo in repos]
+    pipe = get_pipeline()
+    for key in keys:
+        pipe.set(key, 1, nx=True, ex=MW_REPO_DEDUP_TTL)
+    new = [(repo, key) for repo, key, is_new in zip(repos, keys, pipe.execute()) if is_new]
+    for i in range(0, len(new), MW_REPO_CHUNK_SIZE):
+        try:
+            MWCourseAddReposDelay.delay(
+                [repo for repo, _ in new[i:i + MW_REPO_CHUNK_SIZE]])
+        except:
+            get_redis().delete(*[key for _, key in new[i:]])
+            raise
+
+
+def enrol_job_key(job_id):
+    return 'enrol_job:{}'.format(job_id)
+
+
+def create_enrol_job(job_id, course_uid, total):
+    pipe = get_pipeline()
+    pipe.hset(enrol_job_key(job_id), mapping={
+        'course_uid': str(course_uid), 'state': 'pending', 'total': total, 'done': 0, 'failed': 0, 'repos': 0})
+    pipe.expire(enrol_job_key(job_id), ENROL_JOB_TTL)
+    pipe.execute()
+
+
+def get_enrol_job(job_id):
+    '''
+    Returns the progress of a bulk enrolment job, or `None` if it is unknown.
+    '''
+    job = get_redis().hgetall(enrol_job_key(job_id))
+    if not job:
+        return None
+    job = {k.decode(): v.decode() for k, v in job.items()}
+    for field in ('total', 'done', 'failed', 'repos'):
+        job[field] = int(job[field])
+    return job
 
 
 @celery_app.task
-def MWCourseDelRepoDelay(*args):
-    print("Add MWCourseDelRepo job:"+str(args))
-    MWCourseDelRepo(*args)
\ No newline at end of file
+def MWCourseBulkEnrolDelay(job_id, user_emails, repos):
+    '''
+    Creates the git users of newly added students, then enqueues their repos.
+    '''
+    celery_logger.info('Add MWCourseBulkEnrol job {}: {} users, {} repos'.format(
+        job_id, len(user_emails), len(repos)))
+    this_redis = get_redis()
+    key = enrol_job_key(job_id)
+    this_redis.hset(key, 'state', 'running')
+    throttle = Throttle()
+    for email in user_emails:
+        throttle.wait()
+        try:
+            MWUpdateUser(email)
+        except MiddlewareError as e:
+            celery_logger.error('MWUpdateUser failed for {}: {}'.format(email, e))
+            this_redis.hincrby(key, 'failed')
+        this_redis.hincrby(key, 'done')
+    provision_repos(repos)
+    this_redis.hset(key, mapping={'repos': len(repos), 'state': 'finished'})
+
+
+def course_provision_key(course_uid):
+    return 'course_provision:{}'.format(UUID(str(course_uid)).hex)
+
+
+def set_course_provision_state(course_uid, state, cause=None):
+    key = course_provision_key(course_uid)
+    pipe = get_pipeline()
+    pipe.hset(key, mapping={'state': state, 'cause': cause or ''})
+    if state == COURSE_PROVISION_READY:
+        pipe.expire(key, COURSE_PROVISION_TTL)
+    else:
+        pipe.persist(key)
+    pipe.execute()
+
+
+def course_created_before_provision_states(course_uid):
+    '''
+    Tells from the time in its uuid1 whether the course was created before
+    the provisioning state was kept. Courses with other uids are taken as
+    created before.
+    '''
+    course_uid = UUID(str(course_uid))
+    if course_uid.version != 1:
+        return True
+    created = datetime.fromtimestamp(
+        (course_uid.time - UUID1_EPOCH_OFFSET) / 1e7, timezone.utc)
+    return created < COURSE_PROVISION_SINCE
+
+
+def get_course_provision_state(course_uid):
+    '''
+    Returns the git provisioning state of a course. Reading a ready state
+    keeps it for another `COURSE_PROVISION_TTL`. Without a state, a course
+    created before the state was kept is taken as ready, and any other course
+    as unknown, since its state expired or was lost.
+    '''
+    key = course_provision_key(course_uid)
+    state = get_redis().hgetall(key)
+    if not state:
+        if course_created_before_provision_states(course_uid):
+            return {'state': COURSE_PROVISION_READY, 'cause': ''}
+        return {'state': COURSE_PROVISION_UNKNOWN, 'cause': ''}
+    state = {k.decode(): v.decode() for k, v in state.items()}
+    if state['state'] == COURSE_PROVISION_READY:
+        get_redis().expire(key, COURSE_PROVISION_TTL)
+    return state
+
+
+@celery_app.task(bind=True, max_retries=MW_TASK_MAX_RETRIES, rate_limit=MW_TASK_RATE_LIMIT)
+def MWCourseProvisionDelay(self, course_uid, course_name, instr_emails):
+    '''
+    Creates the course on the git server and adds its instructors to it. All
+    steps are idempotent, so a retry starts over.
+    '''
+    celery_logger.info('Add MWCourseProvision job: {} {}'.format(course_uid, course_name))
+    try:
+        MWUpdateCourse(course_name, course_uid)
+        for email in instr_emails:
+            if not MW_if_user_exists(email):
+                MWUpdateUser(email)
+            MWCourseAddInstr(course_uid, email)
+    except MWUpdateError as e:
+        celery_logger.error('MWCourseProvision rejected: {}'.format(e))
+        set_course_provision_state(
+            course_uid, COURSE_PROVISION_FAILED, str(e))
+        return
+    except (MiddlewareError, requests.exceptions.RequestException) as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=retry_countdown(self.request.retries))
+        celery_logger.error('MWCourseProvision gave up: {}'.format(e))
+        set_course_provision_state(
+            course_uid, COURSE_PROVISION_FAILED, 'Git server error.')
+        return
+    set_course_provision_state(course_uid, COURSE_PROVISION_READY)
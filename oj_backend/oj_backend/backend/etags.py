@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Conditional GET of course reads.
+
+Every course has a version counter in the cache, bumped by `bump_course_version`
+whenever the course, one of its assignments or its roster changes. Course
+reads are tagged with a weak ETag built from the versions they depend on, so a
+client sending the tag back in `If-None-Match` gets a 304 without the payload
+being read or serialized again.
+
+A missing counter starts from the current time in milliseconds rather than
+from zero, so that a counter lost from the cache never repeats a version
+handed out before.
+"""
+
+import time
+import hashlib
+from uuid import UUID
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+
+
+def _version_key(course_uid):
+    return 'course_version:{}'.format(UUID(str(course_uid)))
+
+
+def _initial_version():
+    return int(time.time() * 1000)
+
+
+def get_course_versions(course_uids):
+    '''
+    Returns a `{course uid: version}` dict of the courses.
+    '''
+    keys = {str(UUID(str(course_uid))): _version_key(course_uid)
+            for course_uid in course_uids}
+    found = cache.get_many(keys.values())
+    versions = {}
+    for course_uid, key in keys.items():
+        if key not in found:
+            cache.add(key, _initial_version(), None)
+            found[key] = cache.get(key)
+        versions[course_uid] = found[key]
+    return versions
+
+
+def bump_course_version(course_uid):
+    '''
+    Invalidates the ETags of the course's reads. Call it after any change to
+    the course, its assignments or its roster.
+    '''
+    try:
+        cache.incr(_version_key(course_uid))
+    except ValueError:
+        cache.set(_version_key(course_uid), _initial_version(), None)
+
+
+def course_etag(course_uids, *parts):
+    '''
+    Returns a weak ETag of a read that depends on the courses and `parts`,
+    such as the path of the read.
+    '''
+    versions = get_course_versions(course_uids)
+    digest = hashlib.sha1(' '.join(['{}:{}'.format(course_uid, version) for course_uid, version in sorted(
+        versions.items())] + [str(part) for part in parts]).encode()).hexdigest()
+    return 'W/{}'.format(quote_etag(digest))
+
+
+def not_modified(request, etag):
+    '''
+    Returns a 304 response if `etag` is among the `If-None-Match` tags of
+    `request`, and `None` otherwise. Tags are compared weakly.
+    '''
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return None
+    weak = etag[2:] if etag.startswith('W/') else etag
+    for tag in parse_etags(if_none_match):
+        if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == weak:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+    return None
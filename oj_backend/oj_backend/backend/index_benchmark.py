@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Before/after measurement of the record indexes of the
+`0001_record_hot_path_indexes` migration.
+
+The indexes are not dropped to measure the queries without them; each hot
+query is instead run again with `IGNORE INDEX` naming them, which is the
+plan MySQL had before the migration. Run it with
+`manage.py benchmark_indexes`.
+"""
+
+import re
+import time
+import statistics
+from importlib import import_module
+from django.db import connection
+from django.db.models import OuterRef, Subquery
+
+from oj_backend.backend.models import Record
+from oj_backend.backend.scoreboard import judged_since
+
+INDEXES = import_module(
+    'oj_backend.backend.migrations.0001_record_hot_path_indexes').INDEXES
+# A table as it appears after FROM or JOIN, with the alias Django gives it
+# in subqueries.
+TABLE = re.compile(r'((?:FROM|JOIN) `(oj_database_record(?:_student)?)`(?: `?U\d+`?)?)')
+
+
+def hot_queries(assignment, student):
+    '''
+    Returns the record reads of the hot paths as `{name: queryset}`, for the
+    records of `assignment` and `student`.
+    '''
+    return {
+        'scoreboard fold': judged_since(assignment.uid, None),
+        'submission history': student.record_set.filter(assignment=assignment).order_by(
+            '-submission_time', '-id').values('id', 'grade', 'submission_time')[:50],
+        'assignment list': assignment.course.assignment_set.annotate(score=Subquery(Record.objects.filter(
+            assignment=OuterRef('pk'), student=student, state=2).order_by('-id').values('grade')[:1])).values(
+            'uid', 'score'),
+    }
+
+
+def ignoring_indexes(sql):
+    '''
+    Returns `sql` with the migration's indexes ignored on every table they
+    are on.
+    '''
+    ignored = {}
+    for table, name, _ in INDEXES:
+        ignored.setdefault(table, []).append('`{}`'.format(name))
+    return TABLE.sub(lambda match: '{} IGNORE INDEX ({})'.format(
+        match.group(1), ', '.join(ignored[match.group(2)])), sql)
+
+
+def estimated_rows(sql, params):
+    '''
+    The rows MySQL estimates to examine for `sql`, summed over its tables.
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in cursor.description]
+        return sum(dict(zip(columns, row))['rows'] or 0 for row in cursor.fetchall())
+
+
+def median_seconds(sql, params, repeat):
+    timings = []
+    with connection.cursor() as cursor:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def measure(queryset, repeat=5):
+    '''
+    Returns `(with, without)` for the query of `queryset` with and without
+    the indexes, each a `(estimated rows, median seconds)` pair.
+    '''
+    sql, params = queryset.query.sql_with_params()
+    return tuple((estimated_rows(i, params), median_seconds(i, params, repeat))
+                 for i in (sql, ignoring_indexes(sql)))
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Per-request cost accounting.
+
+`RequestMetricsMiddleware` counts the SQL queries, redis round trips and
+`oj-middleware` calls a request makes and the time spent in each. They are
+returned in the `Server-Timing` header and logged as one JSON line per
+request. Requests slower than `OJBN_SLOW_REQUEST_MS` are sampled into a
+warning carrying their SQL statements.
+
+Redis is measured by `InstrumentedConnection`, the connection class of the
+shared pools, and by `InstrumentedAsyncConnection`, that of the
+`redis.asyncio` pool of the async views. SQL is measured by an execute
+wrapper installed on every database connection as it is created, and the
+middleware calls by `baseMiddlewareAdopter` and `MW_if_user_exists`, which
+report to `record_middleware_call`. All of
+them report to the metrics of the current context, which `sync_to_async`
+carries over to the threads running the ORM of async views. This module is imported by the settings,
+so it must not import models.
+"""
+
+import os
+import time
+import random
+import logging
+from contextvars import ContextVar
+import redis
+import redis.asyncio as aioredis
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+try:
+    from django.utils import simplejson
+except:
+    import simplejson
+
+metrics_logger = logging.getLogger('backend.main')
+
+OJBN_REQUEST_METRICS = os.environ.get(
+    'OJBN_REQUEST_METRICS', 'true').lower() in ('1', 'true', 'yes')
+OJBN_SLOW_REQUEST_MS = float(os.environ.get('OJBN_SLOW_REQUEST_MS', 1000))
+OJBN_SLOW_REQUEST_SAMPLE_RATE = float(
+    os.environ.get('OJBN_SLOW_REQUEST_SAMPLE_RATE', 0.1))
+# At most this many SQL statements are kept for a slow request sample.
+MAX_SAMPLED_QUERIES = 100
+
+_current_metrics = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+
+    '''
+    Counters of one request. Times are in seconds.
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.db_count = 0
+        self.db_time = 0.0
+        self.redis_count = 0
+        self.redis_time = 0.0
+        self.mw_count = 0
+        self.mw_time = 0.0
+        self.queries = []
+
+    def server_timing(self, total):
+        return ', '.join([
+            'db;dur={:.1f};desc="{} queries"'.format(
+                self.db_time * 1000, self.db_count),
+            'redis;dur={:.1f};desc="{} calls"'.format(
+                self.redis_time * 1000, self.redis_count),
+            'mw;dur={:.1f};desc="{} calls"'.format(
+                self.mw_time * 1000, self.mw_count),
+            'total;dur={:.1f}'.format(total * 1000),
+        ])
+
+
+def current_metrics():
+    return _current_metrics.get()
+
+
+def record_redis_call(elapsed):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.redis_count += 1
+        metrics.redis_time += elapsed
+
+
+def record_middleware_call(elapsed):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.mw_count += 1
+        metrics.mw_time += elapsed
+
+
+class InstrumentedConnection(redis.Connection):
+
+    '''
+    A redis connection that reports every round trip, a pipeline counting
+    as one, to the metrics of the current request.
+    '''
+
+    def send_packed_command(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super().send_packed_command(*args, **kwargs)
+        finally:
+            record_redis_call(time.time() - start)
+
+    def read_response(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super().read_response(*args, **kwargs)
+        finally:
+            metrics = _current_metrics.get()
+            if metrics is not None:
+                metrics.redis_time += time.time() - start
+
+
+class InstrumentedAsyncConnection(aioredis.Connection):
+
+    '''
+    The `redis.asyncio` counterpart of `InstrumentedConnection`.
+    '''
+
+    async def send_packed_command(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return await super().send_packed_command(*args, **kwargs)
+        finally:
+            record_redis_call(time.time() - start)
+
+    async def read_response(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return await super().read_response(*args, **kwargs)
+        finally:
+            metrics = _current_metrics.get()
+            if metrics is not None:
+                metrics.redis_time += time.time() - start
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.time()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_count += 1
+        metrics.db_time += time.time() - start
+        if len(metrics.queries) < MAX_SAMPLED_QUERIES:
+            metrics.queries.append(sql)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    # Also sent when a closed connection reconnects.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class RequestMetricsMiddleware:
+
+    '''
+    Measures the SQL, redis and `oj-middleware` cost of every request.
+    Disabled by `OJBN_REQUEST_METRICS=false`. Runs both under WSGI and ASGI.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        if OJBN_REQUEST_METRICS:
+            from django.db.backends.signals import connection_created
+            connection_created.connect(
+                install_query_recorder, dispatch_uid='ojbn_request_metrics')
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not OJBN_REQUEST_METRICS:
+            return self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        if not OJBN_REQUEST_METRICS:
+            return await self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        total = time.time() - metrics.start
+        response['Server-Timing'] = metrics.server_timing(total)
+        self.log(request, response, metrics, total)
+        return response
+
+    def log(self, request, response, metrics, total):
+        line = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 1),
+            'db_count': metrics.db_count,
+            'db_ms': round(metrics.db_time * 1000, 1),
+            'redis_count': metrics.redis_count,
+            'redis_ms': round(metrics.redis_time * 1000, 1),
+            'mw_count': metrics.mw_count,
+            'mw_ms': round(metrics.mw_time * 1000, 1),
+        }
+        metrics_logger.info('request_metrics {}'.format(simplejson.dumps(line)))
+        if total * 1000 >= OJBN_SLOW_REQUEST_MS and random.random() < OJBN_SLOW_REQUEST_SAMPLE_RATE:
+            line['queries'] = metrics.queries
+            metrics_logger.warning(
+                'slow_request {}'.format(simplejson.dumps(line)))
@@ -0,0 +1,446 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Helpers around the per-assignment judge queue.
+
+Pending submissions of an assignment are kept in a redis sorted set named by
+the assignment uid, which `oj-scheduler` pops from. Every time the backend
+changes a queue, it publishes on the queue's update channel so that clients
+streaming their queue position are woken up.
+
+Entries are JSON payloads by default. With `OJBN_QUEUE_ENCODING=compact`, an
+entry is only the id of its record, and the receive time and owners needed to
+show the queue are kept in the assignment's `queue_meta:<assignment uid>`
+hash, field per record id. The scheduler pops entries without telling the
+backend, so the fields of popped entries are pruned by the next push once
+they outnumber the queue, and the hash expires `QUEUE_ENTRY_TTL` after the
+last push; the scheduler then reads the upstream from the record's `redis_message`.
+Readers understand both, so the encoding can be switched with a full queue.
+
+The entries queued for each owner are indexed in a
+`queue_user:<assignment uid>:<user uid>` set, so that a user's position is
+found without reading the queue. Entries the scheduler has popped are dropped
+from it when next looked up.
+
+The helpers here are shared by the sync views and their async variants.
+"""
+
+import os
+import time
+import logging
+from datetime import datetime
+from uuid import UUID
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from redis.exceptions import RedisError
+try:
+    from django.utils import simplejson
+except:
+    import simplejson
+
+from oj_backend.backend.models import Student, Assignment, Record
+from oj_backend.backend.metrics import SUBMISSIONS_INGESTED
+from oj_backend.backend import queue_policy
+from oj_backend.backend.redis_client import get_pipeline
+
+queue_logger = logging.getLogger('backend.main')
+
+ASSIGNMENT_CACHE_TIMEOUT = 10 * 60
+
+RECORD_STATE_PENDING = 1
+# A pending record whose queue entry was replaced by a newer push of the same
+# owners in latest-only mode. It is never judged.
+RECORD_STATE_SUPERSEDED = 4
+
+OJBN_QUEUE_ENCODING = os.environ.get('OJBN_QUEUE_ENCODING', 'json').lower()
+# Outlives any entry still waiting in a queue of an assignment pushed to last.
+QUEUE_ENTRY_TTL = 7 * 24 * 60 * 60
+# Metadata of popped entries kept beyond the length of the queue before the
+# next push prunes it. Pruning walks the hash, so it must not run every push.
+QUEUE_PRUNE_SLACK = 64
+
+
+def queue_update_channel(assignment_uid):
+    return 'queue_update:{}'.format(assignment_uid)
+
+
+def notify_queue_changed(this_redis, assignment_uid):
+    this_redis.publish(queue_update_channel(assignment_uid), str(assignment_uid))
+
+
+def _assignment_info_key(assignment_uid):
+    return 'ingest_assignment:{}'.format(assignment_uid)
+
+
+def _assignment_info(assignment_uid):
+    '''
+    Returns the primary key and the deadline of the assignment with
+    `assignment_uid`, cached since every push of a deadline burst names one
+    of a few assignments. Raises `Assignment.DoesNotExist` if there is none.
+    '''
+    key = _assignment_info_key(assignment_uid)
+    info = cache.get(key)
+    if info is None:
+        info = Assignment.objects.filter(
+            uid=assignment_uid).values_list('pk', 'deadline').first()
+        if info is None:
+            raise Assignment.DoesNotExist(
+                'No Assignment matches {}.'.format(assignment_uid))
+        cache.set(key, info, ASSIGNMENT_CACHE_TIMEOUT)
+    return info
+
+
+def forget_assignment_info(assignment_uid):
+    '''
+    Drops the cached `_assignment_info` of an assignment that was changed or
+    deleted, under every form of the uid a push may name it by.
+    '''
+    assignment_uid = UUID(str(assignment_uid))
+    cache.delete_many([_assignment_info_key(uid)
+                       for uid in (str(assignment_uid), assignment_uid.hex)])
+
+
+# Queues an entry, and its metadata if it is compact. In latest-only mode an
+# owner's entry still pending is replaced by the new one, which keeps its
+# place, and the replaced entry is returned. The owner index and the metadata
+# hash are pruned of popped entries once either outnumbers the queue. Entries without owners, passed
+# as an empty owner, are never coalesced, as they would all replace each
+# other.
+#
+# KEYS: queue, owner index, latest-only flag, metadata hash.
+# ARGV: owner, entry, score, metadata (empty for JSON entries), TTL of the
+# owner index and metadata, prune slack.
+COALESCE_SCRIPT = """
+local superseded = false
+if ARGV[1] ~= '' and redis.call('EXISTS', KEYS[3]) == 1 then
+    local previous = redis.call('HGET', KEYS[2], ARGV[1])
+    if previous then
+        local previous_score = redis.call('ZSCORE', KEYS[1], previous)
+        if previous_score then
+            redis.call('ZREM', KEYS[1], previous)
+            redis.call('HDEL', KEYS[4], previous)
+            ARGV[3] = previous_score
+            superseded = previous
+        end
+    end
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[4], ARGV[2], ARGV[4])
+    redis.call('EXPIRE', KEYS[4], ARGV[5])
+end
+local limit = 2 * redis.call('ZCARD', KEYS[1]) + tonumber(ARGV[6])
+if redis.call('HLEN', KEYS[4]) > limit then
+    for _, field in ipairs(redis.call('HKEYS', KEYS[4])) do
+        if not redis.call('ZSCORE', KEYS[1], field) then
+            redis.call('HDEL', KEYS[4], field)
+        end
+    end
+end
+if redis.call('HLEN', KEYS[2]) > limit then
+    local owners = redis.call('HGETALL', KEYS[2])
+    for i = 1, #owners, 2 do
+        if not redis.call('ZSCORE', KEYS[1], owners[i + 1]) then
+            redis.call('HDEL', KEYS[2], owners[i])
+        end
+    end
+end
+return superseded
+"""
+
+
+_coalesce_script = None
+
+
+def _coalesce(this_redis):
+    '''
+    Returns `COALESCE_SCRIPT` registered once per process, so that pushes
+    send its hash instead of its source.
+    '''
+    global _coalesce_script
+    if _coalesce_script is None:
+        _coalesce_script = this_redis.register_script(COALESCE_SCRIPT)
+    return _coalesce_script
+
+
+def _owner_index_key(assignment_uid):
+    return 'queue_owner:{}'.format(UUID(str(assignment_uid)).hex)
+
+
+def _latest_only_key(assignment_uid):
+    return 'queue_latest_only:{}'.format(UUID(str(assignment_uid)).hex)
+
+
+def is_latest_only(this_redis, assignment_uid):
+    return bool(this_redis.exists(_latest_only_key(assignment_uid)))
+
+
+def set_latest_only(this_redis, assignment_uid, latest_only):
+    '''
+    Turns the latest-only mode of an assignment's queue on or off. In this
+    mode a new push of an owner with a submission still pending replaces it.
+    '''
+    if latest_only:
+        this_redis.set(_latest_only_key(assignment_uid), 1)
+    else:
+        this_redis.delete(_latest_only_key(assignment_uid))
+
+
+def _user_entries_key(assignment_uid, user_uid):
+    try:
+        user_uid = UUID(str(user_uid)).hex
+    except ValueError:
+        pass
+    return 'queue_user:{}:{}'.format(UUID(str(assignment_uid)).hex, user_uid)
+
+
+def _meta_key(assignment_uid):
+    return 'queue_meta:{}'.format(UUID(str(assignment_uid)).hex)
+
+
+def _is_compact(entry):
+    return entry.isdigit()
+
+
+def encode_entry(payload):
+    '''
+    Returns `(entry, meta)`: the queue member of `payload` and, in compact
+    encoding, the string kept in the assignment's `_meta_key` hash.
+    '''
+    if OJBN_QUEUE_ENCODING == 'compact':
+        return str(payload['record_id']), '{}|{}'.format(payload['receive_time'], ','.join(payload['owner_uids'] or []))
+    return simplejson.dumps(payload), None
+
+
+def _record_id_of(entry):
+    if isinstance(entry, bytes):
+        entry = entry.decode()
+    if _is_compact(entry):
+        return int(entry)
+    return simplejson.loads(entry)['record_id']
+
+
+def _enqueue(this_redis, assignment_uid, owner_uids, entry, meta, score):
+    pipe = get_pipeline(this_redis)
+    _coalesce(this_redis)(keys=[assignment_uid, _owner_index_key(assignment_uid), _latest_only_key(assignment_uid),
+                                _meta_key(assignment_uid)],
+                          args=[','.join(sorted(owner_uids or [])), entry, score, meta or '', QUEUE_ENTRY_TTL,
+                                QUEUE_PRUNE_SLACK],
+                          client=pipe)
+    for owner_uid in owner_uids or []:
+        pipe.sadd(_user_entries_key(assignment_uid, owner_uid), entry)
+        pipe.expire(_user_entries_key(assignment_uid, owner_uid), QUEUE_ENTRY_TTL)
+    notify_queue_changed(pipe, assignment_uid)
+    superseded = pipe.execute()[0]
+    SUBMISSIONS_INGESTED.inc()
+    if superseded:
+        record_id = _record_id_of(superseded)
+        Record.objects.filter(id=record_id, state=RECORD_STATE_PENDING).update(
+            state=RECORD_STATE_SUPERSEDED)
+        queue_logger.info('Record {} superseded in the queue of {}.'.format(
+            record_id, assignment_uid))
+
+
+def _enqueue_or_discard(this_redis, record_id, assignment_uid, owner_uids, entry, meta, score):
+    '''
+    Queues a committed record. If redis fails, the record is deleted before
+    the error is raised, so that the middleware retrying the push does not
+    leave a pending record behind that is never judged.
+    '''
+    try:
+        _enqueue(this_redis, assignment_uid, owner_uids, entry, meta, score)
+    except RedisError:
+        Record.objects.filter(id=record_id).delete()
+        queue_logger.error('Record {} could not be queued for {} and was discarded.'.format(
+            record_id, assignment_uid))
+        raise
+
+
+def ingest_submission(this_redis, data):
+    '''
+    Handles a push relayed by `oj-*-middleware`: a push to a grading script
+    repo is published on `grade_script_pushed`, a push to a student's repo
+    creates a pending `Record` and is queued for judging. Raises `KeyError`
+    if a required field is missing from `data`.
+    '''
+    now = int(time.time())
+    upstream = data['upstream']
+    try:
+        owner_uids = simplejson.loads(data['additional_data'])
+    except:
+        owner_uids = None
+    assignment_uid = data["assignment_uid"]
+    if isinstance(owner_uids, str):
+        owner_uids = [owner_uids]
+    payload = {'upstream': upstream,
+               "owner_uids": owner_uids, 'receive_time': now}
+    if upstream.endswith("_grading_script.git"):
+        # The upstream stores the grading script.
+        payload = simplejson.dumps(payload)
+        channel = "grade_script_pushed"
+        queue_logger.info('Submission relied. Payload: {}; Channel: {}'.format(
+            payload, channel))
+        this_redis.publish(channel, payload)
+    else:
+        # The upstream stores the student's submission. The record and its
+        # owners are written in one transaction, and queued only once
+        # committed so that the judge never pops a record it cannot read.
+        assignment_pk, deadline = _assignment_info(assignment_uid)
+        submission_time = timezone.make_aware(datetime.fromtimestamp(now))
+        with transaction.atomic():
+            R = Record.objects.create(assignment_id=assignment_pk,
+                                      grade=0,
+                                      delta=0,
+                                      grade_time=timezone.make_aware(
+                                          datetime.fromtimestamp(0)),
+                                      submission_time=submission_time,
+                                      redis_message=simplejson.dumps(
+                                          payload),
+                                      state=RECORD_STATE_PENDING)
+            student_ids = list(Student.objects.filter(
+                user__in=owner_uids).values_list('id', flat=True))
+            Record.student.through.objects.bulk_create([Record.student.through(
+                record_id=R.id, student_id=student_id) for student_id in student_ids])
+            weight = queue_policy.score(queue_policy.Submission(
+                assignment_pk, deadline, student_ids, R.id, submission_time))
+            payload['record_id'] = R.id
+            entry, meta = encode_entry(payload)
+            queue_logger.info('Submission relied. Payload: {}; Channel: {}; Weight: {}'.format(
+                simplejson.dumps(payload), assignment_uid, weight))
+            transaction.on_commit(lambda: _enqueue_or_discard(
+                this_redis, R.id, assignment_uid, owner_uids, entry, meta, weight))
+
+
+def parse_page(query, page_size, max_page_size):
+    '''
+    Returns `(offset, limit)` from the `offset` and `limit` query parameters.
+    Raises `ValueError` if they are malformed.
+    '''
+    offset = int(query.get('offset', 0))
+    limit = int(query.get('limit', page_size))
+    if offset < 0 or limit <= 0:
+        raise ValueError('offset and limit out of range.')
+    return offset, min(limit, max_page_size)
+
+
+def pending_meta_fields(raw_pending):
+    '''
+    Returns the fields of the metadata hash to fetch, in order, for the
+    compact entries of `raw_pending` before it can be decoded.
+    '''
+    return [entry.decode() for entry in raw_pending if _is_compact(entry.decode())]
+
+
+def decode_pending(raw_pending, metas=()):
+    '''
+    Decodes queue entries of both encodings. `metas` are the values of
+    `pending_meta_fields(raw_pending)`.
+    '''
+    metas = iter(metas)
+    pending = []
+    for entry in raw_pending:
+        entry = entry.decode()
+        if not _is_compact(entry):
+            pending.append(simplejson.loads(entry))
+            continue
+        meta = next(metas, None)
+        receive_time, owner_uids = meta.decode().split(
+            '|', 1) if meta else (None, '')
+        pending.append({'record_id': int(entry), 'receive_time': int(receive_time) if receive_time else None,
+                        'owner_uids': [uid for uid in owner_uids.split(',') if uid]})
+    return pending
+
+
+def read_pending(this_redis, assignment_uid, raw_pending):
+    fields = pending_meta_fields(raw_pending)
+    return decode_pending(raw_pending, this_redis.hmget(_meta_key(assignment_uid), fields) if fields else ())
+
+
+async def async_read_pending(this_redis, assignment_uid, raw_pending):
+    '''
+    `read_pending` for a `redis.asyncio` client.
+    '''
+    fields = pending_meta_fields(raw_pending)
+    return decode_pending(raw_pending, await this_redis.hmget(_meta_key(assignment_uid), fields) if fields else ())
+
+
+def resolve_nicknames(pending):
+    '''
+    Returns a `{user uid: nickname}` dict for all owners of `pending`, using
+    a single query.
+    '''
+    owner_uids = set()
+    for submission in pending:
+        owner_uids.update(submission['owner_uids'] or [])
+    return {str(uid): nickname for uid, nickname in Student.objects.filter(
+        user__uid__in=owner_uids).values_list('user__uid', 'nickname')}
+
+
+def format_pending(pending, nicknames):
+    pending_list = []
+    for submission in pending:
+        display_submission = {}
+        display_submission['submission_time'] = submission['receive_time']
+        display_submission['submitter'] = ', '.join(nicknames[submitter] for submitter in (
+            submission['owner_uids'] or []) if submitter in nicknames)
+        pending_list.append(display_submission)
+    return pending_list
+
+
+def _position_of(ranks, total):
+    ranks = [rank for rank in ranks if rank is not None]
+    return (min(ranks) + 1 if ranks else None), total
+
+
+def queue_position(this_redis, assignment_uid, user_uid):
+    '''
+    Returns `(position, total)` where `position` is the 1-based position of
+    the first pending submission owned by `user_uid`, or `None` if the user
+    has nothing pending.
+    '''
+    key = _user_entries_key(assignment_uid, user_uid)
+    entries = list(this_redis.smembers(key))
+    pipe = get_pipeline(this_redis)
+    for entry in entries:
+        pipe.zrank(str(assignment_uid), entry)
+    pipe.zcard(str(assignment_uid))
+    *ranks, total = pipe.execute()
+    popped = [entry for entry, rank in zip(entries, ranks) if rank is None]
+    if popped:
+        this_redis.srem(key, *popped)
+    return _position_of(ranks, total)
+
+
+async def async_queue_position(this_redis, assignment_uid, user_uid):
+    '''
+    `queue_position` for a `redis.asyncio` client.
+    '''
+    key = _user_entries_key(assignment_uid, user_uid)
+    entries = list(await this_redis.smembers(key))
+    async with this_redis.pipeline(transaction=False) as pipe:
+        for entry in entries:
+            pipe.zrank(str(assignment_uid), entry)
+        pipe.zcard(str(assignment_uid))
+        *ranks, total = await pipe.execute()
+    popped = [entry for entry, rank in zip(entries, ranks) if rank is None]
+    if popped:
+        await this_redis.srem(key, *popped)
+    return _position_of(ranks, total)
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Load tests run against a deployment, for the management commands
+`replay_ingest` and `compare_load`.
+
+`run_burst` sends requests from a number of threads and keeps the latency of
+each, so that the same burst can be replayed before and after a change, or
+against two deployments, and summarized with `latency_summary`.
+"""
+
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def run_burst(send, count, concurrency):
+    '''
+    Calls `send(session, i)` for `i` in `range(count)` from `concurrency`
+    threads, each with its own `requests.Session`. `send` returns the
+    response. Returns `(latencies, failures, seconds)`: the latency in
+    seconds of each request answered with a 2xx status, the number of the
+    others, and the time the whole burst took.
+    '''
+    local = threading.local()
+
+    def timed(i):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = send(local.session, i)
+        except requests.RequestException:
+            return None
+        if not 200 <= response.status_code < 300:
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, range(count)))
+    seconds = time.perf_counter() - start
+    latencies = [i for i in results if i is not None]
+    return latencies, len(results) - len(latencies), seconds
+
+
+def percentile(values, p):
+    '''
+    Returns the `p`th percentile of `values` by the nearest rank.
+    '''
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def latency_summary(latencies, failures, seconds):
+    '''
+    Formats the result of `run_burst` on one line.
+    '''
+    return '{} ok, {} failed in {:.1f}s ({:.0f}/s); p50 {:.1f}ms, p99 {:.1f}ms'.format(
+        len(latencies), failures, seconds, len(latencies) / seconds if seconds else 0,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
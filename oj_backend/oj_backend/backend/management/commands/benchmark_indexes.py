@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import random
+from datetime import timedelta
+from uuid import uuid1
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from oj_backend.backend.models import User, Student, Course, Assignment, Record
+from oj_backend.backend.index_benchmark import hot_queries, measure
+
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+
+    '''
+    `manage.py benchmark_indexes`: seeds a course with records and prints,
+    for each hot record query, the rows MySQL estimates to examine and the
+    median latency with and without the record indexes. The seeded rows are
+    kept, so run it against a scratch database.
+    '''
+    help = 'Measures the record hot path queries with and without their indexes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=1000000)
+        parser.add_argument('--assignments', type=int, default=50)
+        parser.add_argument('--students', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='runs of each query the median is taken over')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def seed(self, options):
+        rng = random.Random(options['seed'])
+        now = timezone.now()
+        course = Course.objects.create(uid=uuid1(), name='benchmark', code='BENCH', year=now.year, semester=1,
+                                       homepage='https://oj.geekpie.club/', creator=uuid1())
+        assignments = [Assignment.objects.create(uid=uuid1(), course=course, name='hw{}'.format(i),
+                                                 short_name='hw{}'.format(i), descr_link='https://oj.geekpie.club/',
+                                                 grade=100, state=1, deadline=now, release_date=now)
+                       for i in range(options['assignments'])]
+        students = []
+        for i in range(options['students']):
+            user = User.objects.create(email='bench{}.{}@shanghaitech.edu.cn'.format(course.code, uuid1().hex),
+                                       name='bench{}'.format(i))
+            students.append(Student.objects.create(user=user, enroll_email=user.email,
+                                                   student_id='bench{}'.format(i), nickname='bench{}'.format(i)))
+        course.students.add(*students)
+        # Ids are given explicitly, as MySQL does not return the ids of bulk
+        # inserted rows.
+        next_id = (Record.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+        for start in range(0, options['records'], BATCH_SIZE):
+            records, owners = [], []
+            for record_id in range(next_id + start, next_id + min(start + BATCH_SIZE, options['records'])):
+                submitted = now - timedelta(seconds=rng.randrange(30 * 24 * 60 * 60))
+                records.append(Record(id=record_id, assignment=rng.choice(assignments), grade=rng.randrange(101),
+                                      delta=0, state=rng.choice((1, 2, 2, 2, 3)), commit_tag='bench', message='',
+                                      redis_message='{}', grade_time=submitted, submission_time=submitted))
+                owners.append(Record.student.through(
+                    record_id=record_id, student_id=rng.choice(students).id))
+            with transaction.atomic():
+                Record.objects.bulk_create(records)
+                Record.student.through.objects.bulk_create(owners)
+            self.stdout.write('{} records seeded'.format(start + len(records)))
+        return assignments[0], students[0]
+
+    def handle(self, *args, **options):
+        assignment, student = self.seed(options)
+        self.stdout.write('{:<20} {:>12} {:>12} {:>12} {:>12}'.format(
+            '', 'rows before', 'rows after', 'ms before', 'ms after'))
+        for name, queryset in hot_queries(assignment, student).items():
+            (rows, seconds), (rows_before, seconds_before) = measure(
+                queryset, options['repeat'])
+            self.stdout.write('{:<20} {:>12} {:>12} {:>12.2f} {:>12.2f}'.format(
+                name, rows_before, rows, seconds_before * 1000, seconds * 1000))
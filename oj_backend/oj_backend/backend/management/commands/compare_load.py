@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from oj_backend.backend.load_testing import run_burst, latency_summary
+
+
+class Command(BaseCommand):
+
+    '''
+    `manage.py compare_load`: sends the same burst of `GET`s to the sync and
+    the async deployment of the backend (`OJBN_SERVER_MODE`) and prints the
+    throughput and latency of each.
+    '''
+    help = 'Compares the concurrent-request throughput of two deployments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='path requested, e.g. /api/course/<uid>/assignment/<uid>/scores/')
+        parser.add_argument('servers', nargs='+',
+                            help='base URLs, e.g. http://localhost:8000 (wsgi) http://localhost:8001 (asgi)')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=200,
+                            help='requests in flight at once; more than the sync workers to see them queue')
+        parser.add_argument('--header', action='append', default=[],
+                            help='"Name: value" sent with every request, e.g. the session cookie')
+
+    def handle(self, *args, **options):
+        try:
+            headers = dict((i.strip() for i in header.split(':', 1))
+                           for header in options['header'])
+        except ValueError:
+            raise CommandError('Headers are given as "Name: value".')
+        self.stdout.write('{} GET {}, {} at a time'.format(
+            options['requests'], options['path'], options['concurrency']))
+        for server in options['servers']:
+            url = server.rstrip('/') + options['path']
+            self.stdout.write('{:<30} {}'.format(server, latency_summary(*run_burst(
+                lambda session, i: session.get(url, headers=headers),
+                options['requests'], options['concurrency']))))
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+
+from oj_backend.settings import OJ_SUBMISSION_TOKEN
+from oj_backend.backend.models import Assignment
+from oj_backend.backend.load_testing import run_burst, latency_summary
+try:
+    from django.utils import simplejson
+except:
+    import simplejson
+
+
+class Command(BaseCommand):
+
+    '''
+    `manage.py replay_ingest`: posts a burst of pushes by the students of an
+    assignment's course to the internal submission interface of a running
+    backend and prints the p50 and p99 latency. Every push creates a pending
+    record and a queue entry, so run it against a local MySQL and redis.
+    '''
+    help = 'Replays a burst of pushes against the internal submission interface.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='the internal submission interface, '
+                            'e.g. http://localhost:8000/api/internal/submission/')
+        parser.add_argument('assignment', help='uid of the assignment pushed to')
+        parser.add_argument('--pushes', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=64)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            this_assignment = Assignment.objects.select_related(
+                'course').get(uid=options['assignment'])
+        except (Assignment.DoesNotExist, ValueError):
+            raise CommandError('No assignment {}.'.format(options['assignment']))
+        owners = [str(i) for i in this_assignment.course.students.exclude(
+            user=None).values_list('user_id', flat=True)]
+        if not owners:
+            raise CommandError('The course of the assignment has no students.')
+        rng = random.Random(options['seed'])
+        pushes = [rng.choice(owners) for _ in range(options['pushes'])]
+
+        def send(session, i):
+            return session.post(options['url'], headers={'Authorization': OJ_SUBMISSION_TOKEN}, json={
+                'upstream': 'replay/{}/{}.git'.format(this_assignment.uid, pushes[i]),
+                'additional_data': simplejson.dumps([pushes[i]]),
+                'assignment_uid': str(this_assignment.uid)})
+
+        self.stdout.write('{} pushes by {} students, {} at a time'.format(
+            len(pushes), len(owners), options['concurrency']))
+        self.stdout.write(latency_summary(*run_burst(
+            send, len(pushes), options['concurrency'])))
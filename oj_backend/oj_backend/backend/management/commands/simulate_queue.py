@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from django.core.management.base import BaseCommand
+
+from oj_backend.backend import queue_policy
+from oj_backend.backend.queue_simulation import replay, burst, wait_summary
+
+
+class Command(BaseCommand):
+
+    '''
+    `manage.py simulate_queue`: replays a random deadline burst under each
+    given policy set and prints the median and worst per-student wait.
+    '''
+    help = 'Compares judge queue policies on a simulated deadline burst.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('policies', nargs='*', default=['', 'fair_share', 'fair_share,resubmission'],
+                            help='comma separated policy sets to compare; an empty one is first in first out')
+        parser.add_argument('--students', type=int, default=200)
+        parser.add_argument('--pushes', type=int, default=3,
+                            help='pushes per student')
+        parser.add_argument('--heavy-students', type=int, default=10)
+        parser.add_argument('--heavy-pushes', type=int, default=30,
+                            help='pushes per heavy student')
+        parser.add_argument('--window', type=int, default=3600,
+                            help='seconds before the deadline the pushes spread over')
+        parser.add_argument('--judges', type=int, default=4)
+        parser.add_argument('--judge-seconds', type=int, default=30)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        pushes = burst(options['students'], options['pushes'], options['heavy_students'],
+                       options['heavy_pushes'], options['window'], options['seed'])
+        self.stdout.write('{} pushes, {} judges at {}s each'.format(
+            len(pushes), options['judges'], options['judge_seconds']))
+        for names in options['policies']:
+            waits = replay(pushes, queue_policy.get_policies(names), options['judges'],
+                           options['judge_seconds'], options['window'])
+            median, worst = wait_summary(waits)
+            self.stdout.write('{:<40} median {:>8.0f}s  worst {:>8.0f}s'.format(
+                names or 'fifo', median, worst))
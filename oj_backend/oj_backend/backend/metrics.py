@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Prometheus metrics, exposed at `/api/metrics`.
+
+Every gunicorn worker and celery process records into its own files under
+`PROMETHEUS_MULTIPROC_DIR` when it is set, and the exposition view merges
+them, so a scrape sees the whole container whichever worker serves it. Queue
+depths are read from redis at scrape time instead of being recorded.
+"""
+
+import os
+import time
+from datetime import timedelta
+from django.http import HttpResponse, HttpResponseNotFound
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client import multiprocess
+
+OJBN_METRICS_TOKEN = os.environ.get('OJBN_METRICS_TOKEN')
+# Queues of assignments whose deadline passed longer ago are not reported.
+QUEUE_DEPTH_WINDOW = timedelta(days=7)
+
+REQUEST_LATENCY = Histogram(
+    'ojbn_request_duration_seconds', 'Latency of requests by URL pattern.', ['method', 'route', 'status'])
+SUBMISSIONS_INGESTED = Counter(
+    'ojbn_submissions_ingested_total', 'Submissions queued for judging.')
+CELERY_TASK_LATENCY = Histogram(
+    'ojbn_celery_task_duration_seconds', 'Run time of celery tasks.', ['task', 'state'])
+MIDDLEWARE_CALLS = Counter(
+    'ojbn_middleware_calls_total', 'Calls to oj-middleware by outcome.', ['outcome'])
+
+
+def _route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unmatched>'
+    return getattr(match, 'route', None) or match.view_name
+
+
+class PrometheusMetricsMiddleware:
+
+    '''
+    Observes the latency of every request under its URL pattern, so that
+    requests to different courses and assignments share one series. Runs
+    both under WSGI and ASGI.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        start = time.time()
+        response = self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.time()
+        response = await self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    def observe(self, request, response, start):
+        REQUEST_LATENCY.labels(request.method, _route_of(request), response.status_code).observe(
+            time.time() - start)
+
+
+class QueueDepthCollector:
+
+    '''
+    Reports the length of the judge queue of every recent assignment.
+    '''
+
+    def collect(self):
+        from django.utils import timezone
+        from oj_backend.backend.models import Assignment
+        from oj_backend.backend.redis_client import get_pipeline
+        depth = GaugeMetricFamily(
+            'ojbn_judge_queue_depth', 'Submissions waiting in the judge queue.', labels=['assignment'])
+        uids = list(Assignment.objects.filter(
+            deadline__gte=timezone.now() - QUEUE_DEPTH_WINDOW).values_list('uid', flat=True))
+        pipe = get_pipeline()
+        for uid in uids:
+            # The queue is named by the assignment uid as relayed by the
+            # middleware, which may or may not be dashed.
+            pipe.zcard(str(uid))
+            pipe.zcard(uid.hex)
+        lengths = pipe.execute()
+        for i, uid in enumerate(uids):
+            depth.add_metric([uid.hex], lengths[2 * i] + lengths[2 * i + 1])
+        yield depth
+
+
+def task_started(task_id=None, task=None, **kwargs):
+    task.request._ojbn_start = time.time()
+
+
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    start = getattr(task.request, '_ojbn_start', None)
+    if start is not None:
+        CELERY_TASK_LATENCY.labels(task.name.rsplit('.', 1)[-1], state or 'UNKNOWN').observe(
+            time.time() - start)
+
+
+def get_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return registry
+
+
+_queue_depth_registry = CollectorRegistry()
+_queue_depth_registry.register(QueueDepthCollector())
+
+
+def metrics_exposition(request):
+    '''
+    `/api/metrics`
+
+    Requires the `OJBN_METRICS_TOKEN` bearer token, and is not served at all
+    without it. The `Host` header is chosen by the client, so it is no gate.
+    '''
+    if not OJBN_METRICS_TOKEN:
+        return HttpResponseNotFound()
+    if request.META.get('HTTP_AUTHORIZATION') != 'Bearer {}'.format(OJBN_METRICS_TOKEN):
+        return HttpResponse(status=403)
+    output = generate_latest(get_registry()) + \
+        generate_latest(_queue_depth_registry)
+    return HttpResponse(output, content_type=CONTENT_TYPE_LATEST)
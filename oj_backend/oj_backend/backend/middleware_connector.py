@@ -18,19 +18,50 @@
 # TODO: implement this part accordding to interfaces provided by `oj-gitlab-middleware`.
 
 import os
+import time
 import simplejson
 import logging
 from secrets import choice
 from string import ascii_letters, digits
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import quote
 from requests.exceptions import RequestException, ConnectionError, HTTPError, Timeout
 from uuid import UUID
+from oj_backend.backend.instrumentation import record_middleware_call
+from oj_backend.backend.metrics import MIDDLEWARE_CALLS
 
 OJBN_GITLAB_ADDR = os.environ['OJBN_GITLAB_ADDR']
+OJBN_MW_POOL_SIZE = int(os.environ.get('OJBN_MW_POOL_SIZE', 10))
+OJBN_MW_CONNECT_TIMEOUT = float(os.environ.get('OJBN_MW_CONNECT_TIMEOUT', 3))
+OJBN_MW_READ_TIMEOUT = float(os.environ.get('OJBN_MW_READ_TIMEOUT', 30))
+OJBN_MW_RETRIES = int(os.environ.get('OJBN_MW_RETRIES', 3))
+# Calls per second a batch makes to the middleware; 0 for no limit.
+OJBN_MW_CALL_RATE = float(os.environ.get('OJBN_MW_CALL_RATE', 5))
 middleware_logger = logging.getLogger('backend.main')
 
 
+def get_middleware_session():
+    '''
+    Returns a `requests.Session` keeping a pool of keep-alive connections to
+    the middleware. Idempotent requests are retried with backoff on
+    connection errors and 502/503/504.
+    '''
+    retry = Retry(total=OJBN_MW_RETRIES, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=OJBN_MW_POOL_SIZE,
+                          pool_maxsize=OJBN_MW_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Shared by every adopter of this process.
+middleware_session = get_middleware_session()
+
+
 def get_course_project_name(code, year, semaster):
     return "{}-{}{}".format(code, year, semaster)
 
@@ -61,6 +92,25 @@ class MWUpdateError(MiddlewareError):
     pass
 
 
+class Throttle:
+
+    '''
+    Spaces the calls of a batch at least `1 / rate` seconds apart, so that a
+    batch does not hit the git server as fast as it answers.
+    '''
+
+    def __init__(self, rate=OJBN_MW_CALL_RATE):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.last = None
+
+    def wait(self):
+        if self.last is not None:
+            delay = self.last + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.last = time.monotonic()
+
+
 class baseMiddlewareAdopter:
     '''
     This is the base adopter for web interface provided by oj-middleware.
@@ -70,26 +120,31 @@ class baseMiddlewareAdopter:
         self.api_server = api_server
         self.interface = interface
         self.response = None
+        self.elapsed = None
         self._send_request(payload, action)
 
     def _send_request(self, payload, action):
         api_url = "{}{}".format(self.api_server, self.interface)
-        action_func = requests.post
+        action_func = middleware_session.post
         try:
-            action_func = getattr(requests, action.lower())
+            action_func = getattr(middleware_session, action.lower())
         except AttributeError:
             middleware_logger.error(
                 'Could not identify the method {} given.'.format(action))
             raise MiddlewareError('Could not identify the method {} given.'.format(action))
+        start = time.time()
         try:
-            request = action_func(api_url, json=payload)
+            request = action_func(api_url, json=payload, timeout=(
+                OJBN_MW_CONNECT_TIMEOUT, OJBN_MW_READ_TIMEOUT))
             request.raise_for_status()
         except (ConnectionError, Timeout):
+            MIDDLEWARE_CALLS.labels('unreachable').inc()
             cause = 'The connection to middleware server is either broken or timeout.'
             middleware_logger.error(
                 'Connection to the gitlab-middleware server is either broken or timeout. Remote: {}'.format(api_url))
             raise MiddlewareError(cause)
         except HTTPError:
+            MIDDLEWARE_CALLS.labels('rejected').inc()
             middleware_logger.error('Middleware server rejected our request by status code {}. Payload: {}. Response: {}'.format(
                 request.status_code, payload, request.text))
             try:
@@ -98,6 +153,12 @@ class baseMiddlewareAdopter:
                 cause = "Middleware server returns with an unexplianed status code {}.".format(
                     request.status_code)
             raise MWUpdateError(cause)
+        finally:
+            self.elapsed = time.time() - start
+            record_middleware_call(self.elapsed)
+            middleware_logger.debug('{} {} took {:.3f}s.'.format(
+                action.upper(), api_url, self.elapsed))
+        MIDDLEWARE_CALLS.labels('ok').inc()
         self.response = request
 
     @staticmethod
@@ -194,6 +255,35 @@ class MWCourseAddRepo(baseMiddlewareAdopter):
                    'additional_data': owner_uid, 'ddl': ddl}
         super().__init__(api_server=api_server, interface=interface, payload=payload)
 
+class MWCourseAddRepos:
+    '''
+    Adds many repos in one go. Each item of `repos` is a dict of the keyword
+    arguments of `MWCourseAddRepo`. The middleware takes one repo per request,
+    so the requests are sent one after another over the pooled keep-alive
+    connections, paced by `throttle`. A failed repo does not stop the batch: it is collected in
+    `failed` as `(repo, cause)`, and repos that failed because the middleware
+    could not be reached are also listed in `unreachable`.
+    '''
+
+    def __init__(self, repos, api_server=OJBN_GITLAB_ADDR, throttle=None):
+        self.succeeded = []
+        self.failed = []
+        self.unreachable = []
+        throttle = throttle or Throttle()
+        for repo in repos:
+            throttle.wait()
+            try:
+                MWCourseAddRepo(api_server=api_server, **repo)
+                self.succeeded.append(repo)
+            except MWUpdateError as e:
+                self.failed.append((repo, str(e)))
+            except MiddlewareError as e:
+                self.failed.append((repo, str(e)))
+                self.unreachable.append(repo)
+        middleware_logger.debug('Added {} repos on git, {} failed.'.format(
+            len(self.succeeded), len(self.failed)))
+
+
 class MWCourseDelRepo(baseMiddlewareAdopter):
     def __init__(self, course_uid, assignment_uid, owner_email, repo_name=None, api_server=OJBN_GITLAB_ADDR):
         assignment_uid = str(assignment_uid)
@@ -210,7 +300,18 @@ class MWCourseDelRepo(baseMiddlewareAdopter):
         super().__init__(api_server=api_server, interface=interface, action='DELETE')
 
 def MW_if_user_exists(email):
-    r = requests.get('{}/user/{}'.format(OJBN_GITLAB_ADDR, quote(email)))
+    # Counted like the calls of `baseMiddlewareAdopter`; a missing user is an
+    # answer, not a rejection.
+    start = time.time()
+    try:
+        r = middleware_session.get('{}/user/{}'.format(OJBN_GITLAB_ADDR, quote(email)), timeout=(
+            OJBN_MW_CONNECT_TIMEOUT, OJBN_MW_READ_TIMEOUT))
+    except (ConnectionError, Timeout):
+        MIDDLEWARE_CALLS.labels('unreachable').inc()
+        raise
+    finally:
+        record_middleware_call(time.time() - start)
+    MIDDLEWARE_CALLS.labels('ok' if r.status_code in (204, 404) else 'rejected').inc()
     if r.status_code == 204:
         return True
     return False
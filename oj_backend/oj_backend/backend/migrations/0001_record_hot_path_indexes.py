@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Composite indexes for the hot read paths of the backend.
+
+The tables belong to `oj-database`, whose models are shared with
+`oj-scheduler`, so the indexes are added here with plain SQL instead of
+changing the models' `Meta.indexes`.
+"""
+
+from django.db import migrations
+
+INDEXES = (
+    # scoreboards and the judged-record filter of the assignment list.
+    ('oj_database_record', 'ojbn_record_assignment_state_id',
+     '`assignment_id`, `state`, `id`'),
+    # the grade_time watermark read of the materialized scoreboard.
+    ('oj_database_record', 'ojbn_record_assignment_state_gradetime',
+     '`assignment_id`, `state`, `grade_time`'),
+    # submission history, ordered by submission time.
+    ('oj_database_record', 'ojbn_record_assignment_subtime',
+     '`assignment_id`, `submission_time`'),
+    # records of a student.
+    ('oj_database_record_student', 'ojbn_record_student_student_record',
+     '`student_id`, `record_id`'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        # The migration creating the record tables.
+        ('oj_database', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX `{}` ON `{}` ({});'.format(name, table, columns),
+            reverse_sql='DROP INDEX `{}` ON `{}`;'.format(name, table),
+        ) for table, name, columns in INDEXES
+    ]
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Keyset pagination of submission records.
+
+Records are listed newest first, ordered by `(submission_time, id)`. A page
+ends with a cursor naming its last record, and the next page starts right
+after it, so each page costs one index range scan however deep it is.
+"""
+
+import base64
+import binascii
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(submission_time, record_id):
+    return base64.urlsafe_b64encode('{}|{}'.format(
+        submission_time.isoformat(), record_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Returns `(submission_time, id)` from a cursor given by `encode_cursor`.
+    Raises `ValueError` if it is malformed.
+    '''
+    try:
+        submission_time, record_id = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split('|')
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Malformed cursor.')
+    submission_time = parse_datetime(submission_time)
+    if submission_time is None:
+        raise ValueError('Malformed cursor.')
+    return submission_time, int(record_id)
+
+
+def parse_limit(query, page_size, max_page_size):
+    limit = int(query.get('limit', page_size))
+    if limit <= 0:
+        raise ValueError('limit out of range.')
+    return min(limit, max_page_size)
+
+
+def records_page(queryset, cursor, limit, fields, expressions):
+    '''
+    Returns `(rows, next_cursor)`: the newest `limit` records of `queryset`
+    submitted before `cursor`, as dicts of `fields` and the named
+    `expressions`. `next_cursor` is `None` on the last page.
+    '''
+    if cursor:
+        submission_time, record_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(submission_time__lt=submission_time) | Q(
+            submission_time=submission_time, id__lt=record_id))
+    keys = [key for key in ('id', 'submission_time') if key not in fields]
+    rows = list(queryset.order_by('-submission_time', '-id').values(
+        *fields, *keys, **expressions)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(
+            rows[-1]['submission_time'], rows[-1]['id'])
+    for row in rows:
+        for key in keys:
+            del row[key]
+    return rows, next_cursor
@@ -15,10 +15,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from rest_framework import permissions
 from oj_backend.backend.models import Student, Instructor, Course, Assignment, Record, Judge
 from oj_backend.backend.utils import get_course_uid_from_path as get_course_uid
+from oj_backend.backend.roles import get_course_role
 from uuid import UUID
 import logging
 
@@ -67,21 +69,19 @@ class submissionRecordReadPermission(permissions.BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated:
             return False
-        this_assignment = get_object_or_404(
-            Assignment, uid=view.kwargs['assignment_id'], course__uid=view.kwargs['course_id'])
-        this_course = this_assignment.course
-        return (this_course.instructor.filter(user=request.user).exists()) or (this_course.students.filter(user=request.user).exists())
+        this_role = get_course_role(request, view.kwargs['course_id'])
+        get_object_or_404(this_role.course.assignment_set.all(),
+                          uid=view.kwargs['assignment_id'])
+        return this_role.is_member
 
     def has_object_permission(self, request, view, obj):
         if not request.user.is_authenticated:
             return False
         this_user = request.user
         this_student = obj.student
-        this_instr = obj.assignment.course.instructor.filter(
-            user__uid=this_user.uid)
         if this_user.uid == this_student.user.uid:
             return True
-        return this_instr.exists()
+        return get_course_role(request, obj.assignment.course_id).is_instructor
 
 
 class assignmentInfoReadWritePermisson(permissions.BasePermission):
@@ -99,21 +99,16 @@ class assignmentInfoReadWritePermisson(permissions.BasePermission):
         course_id = view.kwargs.get('uid', view.kwargs.get('course_id', None))
         if not course_id:
             raise KeyError('Unable to find the uid of course.')
-        this_course = get_object_or_404(Course, uid=course_id)
-        return (this_course.instructor.filter(user=request.user)) or (this_course.students.filter(user=request.user))
+        return get_course_role(request, course_id).is_member
 
     def has_object_permission(self, request, view, obj):
         if not request.user.is_authenticated:
             return False
-        this_course = obj.course
-        this_user = request.user
-        this_student = this_course.students.filter(user__uid=this_user.uid)
-        this_instr = this_course.instructor.filter(user__uid=this_user.uid)
+        this_role = get_course_role(request, obj.course_id)
         if request.method in permissions.SAFE_METHODS:
-            return this_instr.exists() or this_student.exists()
+            return this_role.is_member
         else:
-            return this_instr.exists()
-        return False
+            return this_role.is_instructor
 
 
 class courseInstrInfoReadWritePermission(permissions.BasePermission):
@@ -131,27 +126,21 @@ class courseInstrInfoReadWritePermission(permissions.BasePermission):
         course_id = view.kwargs.get('uid', view.kwargs.get('course_id', None))
         if not course_id:
             raise KeyError('Unable to find the uid of course.')
-        this_course = get_object_or_404(Course, uid=course_id)
-        return (this_course.instructor.filter(user=request.user).exists()) or (this_course.students.filter(user=request.user).exists())
+        return get_course_role(request, course_id).is_member
 
     def has_object_permission(self, request, view, obj):
         if not request.user.is_authenticated:
             return False
-        this_course = Course.objects.get(uid=get_course_uid(request.path))
-        if this_course:
-            this_student = this_course.students.filter(
-                user__uid=request.user.uid)
-            this_instr = this_course.instructor.filter(
-                user__uid=request.user.uid)
-        else:
+        try:
+            this_role = get_course_role(request, get_course_uid(request.path))
+        except Http404:
             return False
         if request.method in permissions.SAFE_METHODS:
             # for any user.
-            return this_student.exists() or this_instr.exists()
+            return this_role.is_member
         else:
             # for instructor.
-            return this_instr.exists()
-        return False
+            return this_role.is_instructor
 
 
 class courseStudentInfoReadWritePermission(permissions.BasePermission):
@@ -167,17 +156,15 @@ class courseStudentInfoReadWritePermission(permissions.BasePermission):
         course_id = view.kwargs.get('uid', view.kwargs.get('course_id', None))
         if not course_id:
             raise KeyError('Unable to find the uid of course.')
-        this_course = get_object_or_404(Course, uid=course_id)
-        return this_course.instructor.filter(user=request.user).exists()
+        return get_course_role(request, course_id).is_instructor
 
     def has_object_permission(self, request, view, obj):
         if not request.user.is_authenticated:
             return False
         try:
-            this_course = Course.objects.get(uid=get_course_uid(request.path))
+            return get_course_role(request, get_course_uid(request.path)).is_instructor
         except:
             return False
-        return this_course.instructor.filter(user__uid=request.user.uid).exists()
 
 
 class judgeReadWritePermission(permissions.BasePermission):
@@ -214,19 +201,15 @@ class courseJudgeReadWritePermisson(permissions.BasePermission):
             'uid', view.kwargs.get('course_id', None))
         if not course_id:
             raise KeyError
-        this_course = get_object_or_404(Course, uid=course_id)
-        return this_course.instructor.filter(user=request.user).exists()
+        return get_course_role(request, course_id).is_instructor
 
     def has_object_permission(self, request, view, obj):
         if not request.user.is_authenticated:
             return False
         try:
-            this_course = Course.objects.get(uid=get_course_uid(request.path))
+            return get_course_role(request, get_course_uid(request.path)).is_instructor
         except:
             return False
-        if this_course:
-            return this_course.instructor.filter(user__uid=request.user.uid).exists()
-        return False
 
 
 class courseReadWritePermission(permissions.BasePermission):
@@ -239,13 +222,12 @@ class courseReadWritePermission(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if not request.user.is_authenticated:
             return False
-        instr = obj.instructor.filter(user__uid=request.user.uid)
-        student = obj.students.filter(user__uid=request.user.uid)
+        this_role = get_course_role(request, obj.uid)
         if request.method in permissions.SAFE_METHODS:
             # for any users in this class.
-            return instr.exists() or student.exists()
+            return this_role.is_member
         else:
-            return instr.exists()
+            return this_role.is_instructor
 
 
 class courseRelatedObjReadWritebyInstr(permissions.BasePermission):
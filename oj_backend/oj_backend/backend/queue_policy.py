@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Scoring of submissions in the judge queue.
+
+`oj-scheduler` pops the lowest score of an assignment's queue first. A push
+is scored by its receive time plus the delay, in seconds, every enabled
+policy adds to it, so with no policy the queue is first in first out.
+
+Policies are enabled by name, comma separated, in `OJBN_QUEUE_POLICY`:
+
+- `fair_share` delays a push by each submission of the same owners still
+  pending, so one student pushing repeatedly can not starve the class;
+- `resubmission` delays a push by each submission of the same owners in the
+  last `RESUBMISSION_WINDOW`, pending or judged;
+- `deadline` sends pushes made after the deadline behind all pushes made in
+  time.
+
+Coalescing of superseded pushes is the `latest-only` queue mode, not a score.
+The policies only learn about other records through the `Submission` counts,
+so that `queue_simulation` can replay a burst through them without a
+database.
+"""
+
+import os
+from datetime import timedelta
+
+from oj_backend.backend.models import Record
+
+OJBN_QUEUE_POLICY = os.environ.get('OJBN_QUEUE_POLICY', '')
+FAIR_SHARE_DELAY = int(os.environ.get('OJBN_QUEUE_FAIR_SHARE_DELAY', 60))
+RESUBMISSION_DELAY = int(os.environ.get('OJBN_QUEUE_RESUBMISSION_DELAY', 10))
+RESUBMISSION_WINDOW = timedelta(hours=1)
+# Far more than the spread of receive times in one queue.
+LATE_DELAY = 365 * 24 * 60 * 60
+
+RECORD_STATE_PENDING = 1
+
+
+class Submission:
+
+    '''
+    What the policies know about a push being queued. `record_id` is the
+    record of the push itself, which the policies leave out.
+    '''
+
+    def __init__(self, assignment_pk, deadline, student_ids, record_id, receive_time):
+        self.assignment_pk = assignment_pk
+        self.deadline = deadline
+        self.student_ids = student_ids
+        self.record_id = record_id
+        self.receive_time = receive_time
+
+    def other_records(self):
+        return Record.objects.filter(assignment_id=self.assignment_pk, student__in=self.student_ids).exclude(
+            id=self.record_id)
+
+    def pending_count(self):
+        '''
+        Returns the number of other records of the owners still pending.
+        '''
+        return self.other_records().filter(state=RECORD_STATE_PENDING).values('id').distinct().count()
+
+    def recent_count(self, since):
+        '''
+        Returns the number of other records of the owners submitted since
+        `since`.
+        '''
+        return self.other_records().filter(submission_time__gte=since).values('id').distinct().count()
+
+
+def fair_share(submission):
+    if not submission.student_ids:
+        return 0
+    return submission.pending_count() * FAIR_SHARE_DELAY
+
+
+def resubmission(submission):
+    if not submission.student_ids:
+        return 0
+    return submission.recent_count(submission.receive_time - RESUBMISSION_WINDOW) * RESUBMISSION_DELAY
+
+
+def deadline(submission):
+    if submission.deadline is not None and submission.receive_time > submission.deadline:
+        return LATE_DELAY
+    return 0
+
+
+POLICIES = {
+    'fair_share': fair_share,
+    'resubmission': resubmission,
+    'deadline': deadline,
+}
+
+
+def get_policies(names=OJBN_QUEUE_POLICY):
+    '''
+    Returns the policies named in the comma separated `names`. Raises
+    `KeyError` on an unknown name.
+    '''
+    return [POLICIES[name.strip()] for name in names.split(',') if name.strip()]
+
+
+ENABLED_POLICIES = get_policies()
+
+
+def score(submission, policies=None):
+    '''
+    Returns the queue score of `submission` under `policies`, by default the
+    ones enabled in `OJBN_QUEUE_POLICY`.
+    '''
+    if policies is None:
+        policies = ENABLED_POLICIES
+    return int(submission.receive_time.timestamp()) + sum(policy(submission) for policy in policies)
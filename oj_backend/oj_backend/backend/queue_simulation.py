@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Replay of a submission burst through the judge queue policies.
+
+`replay` scores every push with `queue_policy.score`, as the backend does,
+and drains the queue lowest score first with a number of judges taking a
+fixed time per submission, as `oj-scheduler` does. Everything is kept in
+memory, so policies can be compared before they are enabled with
+`OJBN_QUEUE_POLICY`. Run it with `manage.py simulate_queue`.
+"""
+
+import heapq
+import random
+import statistics
+from datetime import datetime, timedelta, timezone
+
+from oj_backend.backend import queue_policy
+
+EPOCH = datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+
+class ReplayedSubmission(queue_policy.Submission):
+
+    '''
+    A push of the replay. The policies count the pushes of the same student
+    in `history`, the list of all pushes received so far.
+    '''
+
+    def __init__(self, push, history, now, deadline):
+        super().__init__(None, deadline, [push['student']],
+                         push['id'], EPOCH + timedelta(seconds=now))
+        self.push = push
+        self.history = history
+        self.now = now
+
+    def _others(self):
+        return [other for other in self.history
+                if other['student'] == self.push['student'] and other is not self.push]
+
+    def pending_count(self):
+        return len([other for other in self._others() if other['finished'] > self.now])
+
+    def recent_count(self, since):
+        since = (since - EPOCH).total_seconds()
+        return len([other for other in self._others() if other['time'] >= since])
+
+
+def replay(pushes, policies, judges=1, judge_seconds=30, deadline=None):
+    '''
+    Replays `pushes`, `(seconds, student)` pairs, through a queue scored by
+    `policies` and drained by `judges` judges taking `judge_seconds` per
+    push. `deadline` is in seconds as well. Returns the waits, in seconds from
+    the push to the start of its judging, as a `{student: [wait]}` dict.
+    '''
+    if deadline is not None:
+        deadline = EPOCH + timedelta(seconds=deadline)
+    pushes = sorted(pushes)
+    history = []
+    queue = []
+    judges_free_at = [0.0] * judges
+    waits = {}
+    now = 0.0
+    i = 0
+    while i < len(pushes) or queue:
+        next_push = pushes[i][0] if i < len(pushes) else float('inf')
+        if queue and judges_free_at[0] <= next_push:
+            now = max(heapq.heappop(judges_free_at), now)
+            _, _, push = heapq.heappop(queue)
+            push['finished'] = now + judge_seconds
+            heapq.heappush(judges_free_at, push['finished'])
+            waits.setdefault(push['student'], []).append(now - push['time'])
+            continue
+        now, student = pushes[i]
+        push = {'id': i, 'student': student,
+                'time': now, 'finished': float('inf')}
+        history.append(push)
+        score = queue_policy.score(ReplayedSubmission(
+            push, history, now, deadline), policies)
+        heapq.heappush(queue, (score, i, push))
+        i += 1
+    return waits
+
+
+def burst(students, pushes, heavy_students=0, heavy_pushes=0, window=3600, seed=None):
+    '''
+    Returns the pushes of a burst before a deadline: `pushes` per student, and
+    `heavy_pushes` for `heavy_students` of them, at random times in the last
+    `window` seconds.
+    '''
+    rng = random.Random(seed)
+    result = []
+    for student in range(students):
+        count = heavy_pushes if student < heavy_students else pushes
+        result.extend((rng.uniform(0, window), student) for _ in range(count))
+    return result
+
+
+def wait_summary(waits):
+    '''
+    Returns `(median, worst)` over the students of their mean wait.
+    '''
+    per_student = [statistics.mean(student_waits)
+                   for student_waits in waits.values()]
+    return statistics.median(per_student), max(per_student)
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+The shared redis client.
+
+Every process keeps one client over `settings.redisConnectionPool`, and one
+`redis.asyncio` client over `settings.asyncRedisConnectionPool` for the async
+views. Each pool is sized by `OJBN_REDIS_MAX_CONNECTIONS`; when all
+connections are in use a caller waits up to `OJBN_REDIS_POOL_TIMEOUT` seconds
+for one instead of failing at once, and both the waits and the failures are
+counted. This
+module is imported by the settings, so it must not import models.
+"""
+
+import os
+import time
+import redis
+import redis.asyncio as aioredis
+from prometheus_client import Counter, Histogram
+
+OJBN_REDIS_MAX_CONNECTIONS = int(
+    os.environ.get('OJBN_REDIS_MAX_CONNECTIONS', 100))
+OJBN_REDIS_POOL_TIMEOUT = float(os.environ.get('OJBN_REDIS_POOL_TIMEOUT', 5))
+
+REDIS_POOL_WAIT = Histogram('ojbn_redis_pool_wait_seconds',
+                            'Time spent waiting for a redis connection.', buckets=(.001, .01, .1, .5, 1, 5))
+REDIS_POOL_EXHAUSTED = Counter('ojbn_redis_pool_exhausted_total',
+                               'Redis commands that found no free connection in time.')
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+
+    '''
+    A blocking pool that reports its use to prometheus.
+    '''
+
+    def get_connection(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super().get_connection(*args, **kwargs)
+        except redis.exceptions.ConnectionError:
+            # Also raised when the server is down, which does not wait.
+            if time.time() - start >= self.timeout:
+                REDIS_POOL_EXHAUSTED.inc()
+            raise
+        finally:
+            REDIS_POOL_WAIT.observe(time.time() - start)
+
+
+class InstrumentedAsyncConnectionPool(aioredis.BlockingConnectionPool):
+
+    '''
+    The `redis.asyncio` counterpart of `InstrumentedConnectionPool`.
+    '''
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return await super().get_connection(*args, **kwargs)
+        except redis.exceptions.ConnectionError:
+            if time.time() - start >= self.timeout:
+                REDIS_POOL_EXHAUSTED.inc()
+            raise
+        finally:
+            REDIS_POOL_WAIT.observe(time.time() - start)
+
+
+def make_connection_pool(**kwargs):
+    return InstrumentedConnectionPool(max_connections=OJBN_REDIS_MAX_CONNECTIONS, timeout=OJBN_REDIS_POOL_TIMEOUT,
+                                      **kwargs)
+
+
+def make_async_connection_pool(**kwargs):
+    return InstrumentedAsyncConnectionPool(max_connections=OJBN_REDIS_MAX_CONNECTIONS,
+                                           timeout=OJBN_REDIS_POOL_TIMEOUT, **kwargs)
+
+
+_client = None
+_async_client = None
+
+
+def get_redis():
+    '''
+    Returns the shared client of this process.
+    '''
+    global _client
+    if _client is None:
+        from oj_backend.settings import redisConnectionPool
+        _client = redis.Redis(connection_pool=redisConnectionPool)
+    return _client
+
+
+def get_async_redis():
+    '''
+    Returns the shared `redis.asyncio` client of this process.
+    '''
+    global _async_client
+    if _async_client is None:
+        from oj_backend.settings import asyncRedisConnectionPool
+        _async_client = aioredis.Redis(
+            connection_pool=asyncRedisConnectionPool)
+    return _async_client
+
+
+def get_pipeline(this_redis=None):
+    '''
+    Returns a pipeline sending its commands in one round trip. It is not a
+    MULTI/EXEC transaction, which none of the batched paths needs.
+    '''
+    return (this_redis or get_redis()).pipeline(transaction=False)
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Resolves the role of the request's user in a course.
+
+The course and both memberships are loaded with a single query and kept on
+the request, so permission classes and the view share one lookup. The role is
+also cached across requests; every path that changes a course's students or
+instructors, or links a student/instructor to a user, has to call
+`invalidate_course_role` or `invalidate_user_roles`.
+"""
+
+from uuid import UUID
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from oj_backend.backend.models import Student, Instructor, Course
+
+ROLE_CACHE_TIMEOUT = 10 * 60
+
+
+def _role_cache_key(course_uid, user_uid):
+    return 'course_role:{}:{}'.format(course_uid, user_uid)
+
+
+class CourseRole:
+
+    '''
+    The role of a user in a course. `course` is loaded on first access if
+    the role came from the cache.
+    '''
+
+    def __init__(self, course_uid, is_instructor, is_student, course=None):
+        self.course_uid = course_uid
+        self.is_instructor = is_instructor
+        self.is_student = is_student
+        self._course = course
+
+    @property
+    def course(self):
+        if self._course is None:
+            self._course = get_object_or_404(Course, uid=self.course_uid)
+        return self._course
+
+    @property
+    def is_member(self):
+        return self.is_instructor or self.is_student
+
+
+def get_course_role(request, course_uid):
+    '''
+    Returns the `CourseRole` of `request.user` in the course with `course_uid`.
+    Raises `Http404` if the course does not exist.
+    '''
+    roles = getattr(request, '_course_roles', None)
+    if roles is None:
+        roles = {}
+        request._course_roles = roles
+    try:
+        key = str(UUID(str(course_uid)))
+    except ValueError:
+        raise Http404('No Course matches the given query.')
+    if key not in roles:
+        user = request.user
+        cached = None
+        if user.is_authenticated:
+            cached = cache.get(_role_cache_key(key, user.uid))
+        if cached is not None:
+            roles[key] = CourseRole(key, *cached)
+        else:
+            queryset = Course.objects.all()
+            if user.is_authenticated:
+                queryset = queryset.annotate(
+                    is_instructor=Exists(Instructor.objects.filter(
+                        course=OuterRef('pk'), user=user)),
+                    is_student=Exists(Student.objects.filter(
+                        course=OuterRef('pk'), user=user)))
+            this_course = get_object_or_404(queryset, uid=key)
+            roles[key] = CourseRole(key,
+                                    getattr(this_course, 'is_instructor', False),
+                                    getattr(this_course, 'is_student', False),
+                                    this_course)
+            if user.is_authenticated:
+                cache.set(_role_cache_key(key, user.uid),
+                          (roles[key].is_instructor, roles[key].is_student), ROLE_CACHE_TIMEOUT)
+    return roles[key]
+
+
+def invalidate_course_role(course_uid, user):
+    '''
+    Drops the cached role of `user` in the course. `user` may be `None` for
+    students and instructors not yet linked to a user, who have no role.
+    '''
+    if user is None:
+        return
+    cache.delete(_role_cache_key(UUID(str(course_uid)), user.uid))
+
+
+def invalidate_course_roles(course_uid, user_uids):
+    '''
+    `invalidate_course_role` for many users at once, given their uids.
+    '''
+    cache.delete_many([_role_cache_key(UUID(str(course_uid)), user_uid)
+                       for user_uid in user_uids if user_uid is not None])
+
+
+def invalidate_user_roles(user):
+    '''
+    Drops the cached roles of `user` in all courses the user takes or gives.
+    '''
+    course_uids = Course.objects.filter(Q(students__user=user) | Q(
+        instructor__user=user)).values_list('uid', flat=True).distinct()
+    cache.delete_many([_role_cache_key(course_uid, user.uid)
+                       for course_uid in course_uids])
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Materialized scoreboards.
+
+Records are judged by `oj-scheduler`, so the backend never sees the moment a
+record moves to JUDGED. Instead, every assignment keeps a redis hash holding,
+for each student, the latest judged record and the number of judged records.
+A watermark on `grade_time` remembers how far the hash is up to date, and each
+read folds in only the records judged since then, reaching `FOLD_LAG` behind
+the watermark so that a record whose grading commits after a later one has
+been folded is not missed. Records already folded are skipped by id.
+
+The keys of an assignment are named by the hex form of its uid, whichever
+form it is given in, and expire `SCOREBOARD_TTL` after its last fold. They are
+rebuilt from the database if read again after that.
+
+The ranking built from the hash is cached under the assignment and the
+watermark, so it is computed once per newly judged batch and shared by the
+instructor and the public scoreboards, which only project different fields
+out of it.
+"""
+
+import logging
+import redis
+from django.core.cache import cache
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from datetime import timedelta
+from uuid import UUID
+from django.utils.dateparse import parse_datetime
+try:
+    from django.utils import simplejson
+except:
+    import simplejson
+
+from oj_backend.backend.models import Student, Assignment, Record
+from oj_backend.backend.redis_client import get_redis, get_pipeline
+
+scoreboard_logger = logging.getLogger('backend.main')
+
+RECORD_STATE_JUDGED = 2
+FOLD_LOCK_TIMEOUT = 30
+FOLD_LOCK_WAIT = 5
+# Judged records are folded at most once per interval for each assignment.
+FOLD_INTERVAL = 5
+RANKING_CACHE_TIMEOUT = 60
+# How far behind the watermark each fold reads again.
+FOLD_LAG = timedelta(minutes=5)
+SCOREBOARD_TTL = 30 * 24 * 60 * 60
+
+PUBLIC_FIELDS = ('nickname', 'overall_score', 'score', 'delta',
+                 'submission_time', 'submission_count')
+INSTRUCTOR_FIELDS = ('nickname', 'name', 'student_id', 'overall_score', 'score', 'delta',
+                     'submission_time', 'submission_count')
+
+
+def _hex(uid):
+    return UUID(str(uid)).hex
+
+
+def _board_key(assignment_uid):
+    return 'scoreboard:{}'.format(_hex(assignment_uid))
+
+
+def _meta_key(assignment_uid):
+    return 'scoreboard:{}:watermark'.format(_hex(assignment_uid))
+
+
+def _seen_key(assignment_uid):
+    return 'scoreboard:{}:seen'.format(_hex(assignment_uid))
+
+
+def _lock_key(assignment_uid):
+    return 'scoreboard:{}:lock'.format(_hex(assignment_uid))
+
+
+def _fresh_key(assignment_uid):
+    return 'scoreboard:{}:fresh'.format(_hex(assignment_uid))
+
+
+def _ranking_key(course_uid, assignment_uid, watermark):
+    return 'scoreboard_ranking:{}:{}:{}'.format(_hex(course_uid), _hex(assignment_uid), watermark)
+
+
+def _get_watermark(this_redis, assignment_uid):
+    watermark = this_redis.get(_meta_key(assignment_uid))
+    return watermark.decode() if watermark else None
+
+
+def judged_since(assignment_uid, watermark):
+    '''
+    The records of the assignment judged since `watermark`, or all of them
+    without one, as the rows `fold_judged_records` folds.
+    '''
+    records = Record.objects.filter(
+        assignment_id=assignment_uid, state=RECORD_STATE_JUDGED)
+    if watermark:
+        # Records re-read behind the watermark are filtered out by the
+        # `seen` set of the fold.
+        records = records.filter(
+            grade_time__gte=parse_datetime(watermark) - FOLD_LAG)
+    return records.order_by('grade_time', 'id').values_list(
+        'id', 'grade', 'delta', 'submission_time', 'grade_time', 'student')
+
+
+def fold_judged_records(assignment_uid, this_redis=None):
+    '''
+    Fold records of the assignment judged since the last call into the
+    materialized scoreboard. Returns the current watermark.
+    '''
+    if this_redis is None:
+        this_redis = get_redis()
+    assignment_uid = str(assignment_uid)
+    lock = this_redis.lock(_lock_key(assignment_uid),
+                           timeout=FOLD_LOCK_TIMEOUT, blocking_timeout=FOLD_LOCK_WAIT)
+    if not lock.acquire():
+        # Someone else is folding; serve what we have.
+        return _get_watermark(this_redis, assignment_uid)
+    try:
+        watermark = _get_watermark(this_redis, assignment_uid)
+        rows = list(judged_since(assignment_uid, watermark))
+        if not rows:
+            return watermark
+
+        record_ids = sorted(set(row[0] for row in rows))
+        pipe = get_pipeline(this_redis)
+        for record_id in record_ids:
+            pipe.sadd(_seen_key(assignment_uid), record_id)
+        is_new = dict(zip(record_ids, pipe.execute()))
+
+        student_ids = sorted(set(row[5] for row in rows if row[5] is not None))
+        summaries = {}
+        if student_ids:
+            for student_id, summary in zip(student_ids, this_redis.hmget(_board_key(assignment_uid), student_ids)):
+                summaries[student_id] = simplejson.loads(summary) if summary else {
+                    'record_id': 0, 'grade': 0, 'delta': None, 'submission_time': None, 'count': 0}
+
+        for record_id, grade, delta, submission_time, _, student_id in rows:
+            if student_id is None:
+                continue
+            summary = summaries[student_id]
+            if is_new[record_id]:
+                summary['count'] += 1
+            # `>=` so that a regraded latest record updates its grade.
+            if record_id >= summary['record_id']:
+                summary['record_id'] = record_id
+                summary['grade'] = grade
+                summary['delta'] = delta
+                summary['submission_time'] = submission_time.isoformat()
+
+        if not watermark or rows[-1][4] > parse_datetime(watermark):
+            watermark = rows[-1][4].isoformat()
+        pipe = this_redis.pipeline()
+        if summaries:
+            pipe.hset(_board_key(assignment_uid), mapping={
+                student_id: simplejson.dumps(summary) for student_id, summary in summaries.items()})
+        pipe.set(_meta_key(assignment_uid), watermark)
+        # Expire together, so that an expired board is rebuilt from scratch.
+        for key in (_board_key(assignment_uid), _seen_key(assignment_uid), _meta_key(assignment_uid)):
+            pipe.expire(key, SCOREBOARD_TTL)
+        pipe.execute()
+        scoreboard_logger.info('Folded {} judged records into scoreboard of {}. Watermark: {}'.format(
+            len(record_ids), assignment_uid, watermark))
+        return watermark
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            pass
+
+
+def drop_scoreboard(assignment_uid):
+    '''
+    Deletes the materialized scoreboard of a deleted assignment.
+    '''
+    assignment_uid = str(assignment_uid)
+    get_redis().delete(_board_key(assignment_uid), _seen_key(assignment_uid),
+                       _meta_key(assignment_uid), _fresh_key(assignment_uid))
+
+
+def _build_ranking(course_uid, assignment_uid, this_redis):
+    this_assignment = get_object_or_404(
+        Assignment.objects.select_related('course'), uid=assignment_uid, course__uid=course_uid)
+    board = {int(student_id): simplejson.loads(summary) for student_id, summary in this_redis.hgetall(
+        _board_key(assignment_uid)).items()}
+
+    fields = ('id', 'nickname', 'user__name', 'student_id')
+    students = {i['id']: i for i in this_assignment.course.students.all().values(*fields)}
+    missing = [student_id for student_id in board if student_id not in students]
+    if missing:
+        # Students that have left the course still show up with their records.
+        students.update({i['id']: i for i in Student.objects.filter(
+            id__in=missing).values(*fields)})
+
+    graded = []
+    ungraded = []
+    for student_id, student in students.items():
+        row = {
+            'nickname': student['nickname'],
+            'name': student['user__name'],
+            'student_id': student['student_id'],
+            'overall_score': this_assignment.grade,
+            'score': 0,
+            'delta': None,
+            'submission_time': None,
+            'submission_count': 0
+        }
+        summary = board.get(student_id)
+        if summary:
+            row['score'] = summary['grade']
+            row['delta'] = summary['delta']
+            row['submission_time'] = parse_datetime(summary['submission_time'])
+            row['submission_count'] = summary['count']
+            graded.append(row)
+        else:
+            ungraded.append(row)
+    graded.sort(key=lambda x: (-x['score'], x['submission_time'], x['submission_count']))
+    return graded + ungraded
+
+
+def get_ranking(course_uid, assignment_uid):
+    '''
+    Returns the full scoreboard of an assignment with one row for every
+    student that has a judged record or is enrolled in the course. Raises
+    `Http404` if the assignment does not belong to the course.
+    '''
+    course_uid = str(course_uid)
+    assignment_uid = str(assignment_uid)
+    try:
+        _hex(course_uid), _hex(assignment_uid)
+    except ValueError:
+        raise Http404
+    this_redis = get_redis()
+    if this_redis.set(_fresh_key(assignment_uid), 1, nx=True, ex=FOLD_INTERVAL):
+        watermark = fold_judged_records(assignment_uid, this_redis)
+    else:
+        watermark = _get_watermark(this_redis, assignment_uid)
+    key = _ranking_key(course_uid, assignment_uid, watermark)
+    ranking = cache.get(key)
+    if ranking is None:
+        ranking = _build_ranking(course_uid, assignment_uid, this_redis)
+        cache.set(key, ranking, RANKING_CACHE_TIMEOUT)
+    return ranking
+
+
+def project_instructor(ranking):
+    return [{field: row[field] for field in INSTRUCTOR_FIELDS} for row in ranking]
+
+
+def project_public(ranking):
+    return [{field: row[field] for field in PUBLIC_FIELDS} for row in ranking]
@@ -1,3 +1,527 @@
-from django.test import TestCase
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
 
-# Create your tests here.
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
+from uuid import uuid1
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import urlencode
+from asgiref.sync import async_to_sync
+from rest_framework.test import APIClient
+try:
+    from django.utils import simplejson
+except:
+    import simplejson
+
+from oj_backend.backend.models import User, Student, Instructor, Course, Assignment, Record
+from oj_backend.backend import async_views, judge_queue, queue_policy
+from oj_backend.backend import scoreboard
+from oj_backend.backend.scoreboard import judged_since
+from oj_backend.backend.index_benchmark import hot_queries, measure
+from oj_backend.backend.queue_simulation import replay
+from oj_backend.backend.etags import not_modified, course_etag, bump_course_version
+from oj_backend.backend.pagination import encode_cursor, decode_cursor, records_page
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class Fixtures:
+
+    '''
+    Builders of the rows the list views read.
+    '''
+
+    def make_user(self, name):
+        return User.objects.create(email='{}@shanghaitech.edu.cn'.format(name), name=name)
+
+    def make_student(self, name):
+        user = self.make_user(name)
+        return Student.objects.create(user=user, enroll_email=user.email, student_id=name, nickname=name)
+
+    def make_instructor(self, name):
+        user = self.make_user(name)
+        return Instructor.objects.create(user=user, enroll_email=user.email)
+
+    def make_course(self, code):
+        return Course.objects.create(uid=uuid1(), name=code, code=code, year=2018, semester=1,
+                                     homepage='https://oj.geekpie.club/', creator=uuid1())
+
+    def make_assignment(self, course):
+        now = timezone.now()
+        return Assignment.objects.create(uid=uuid1(), course=course, name='hw1', short_name='hw1',
+                                         descr_link='https://oj.geekpie.club/', grade=100, state=1,
+                                         deadline=now + timedelta(days=7), release_date=now)
+
+    def make_record(self, assignment, student, index):
+        now = timezone.now()
+        record = Record.objects.create(assignment=assignment, grade=index, delta=0, state=2, commit_tag=str(index),
+                                       message='', redis_message='{}', grade_time=now,
+                                       submission_time=now - timedelta(minutes=index))
+        record.student.add(student)
+        return record
+
+    def make_records(self, assignment, student, count, state=2):
+        '''
+        Bulk variant of `make_record` for seeding many records.
+        '''
+        now = timezone.now()
+        Record.objects.bulk_create([Record(assignment=assignment, grade=i, delta=0, state=state, commit_tag='bulk',
+                                           message='', redis_message='{}', grade_time=now - timedelta(seconds=i),
+                                           submission_time=now - timedelta(seconds=i)) for i in range(count)])
+        # MySQL does not return the ids of bulk inserted rows.
+        record_ids = Record.objects.filter(assignment=assignment, commit_tag='bulk',
+                                           student=None).values_list('id', flat=True)
+        Record.student.through.objects.bulk_create([Record.student.through(
+            record_id=record_id, student_id=student.id) for record_id in record_ids])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ListQueryCountTests(Fixtures, TestCase):
+
+    '''
+    The list views must not issue a query per row: listing 2N rows takes as
+    many queries as listing N.
+    '''
+    rows = 5
+
+    def setUp(self):
+        cache.clear()
+        self.instructor = self.make_instructor('instr')
+        self.student = self.make_student('student')
+        self.course = self.make_course('SI100C')
+        self.course.instructor.add(self.instructor)
+        self.course.students.add(self.student)
+        self.assignment = self.make_assignment(self.course)
+        self.created = 0
+
+    def client_of(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def next_name(self, prefix):
+        self.created += 1
+        return '{}{}'.format(prefix, self.created)
+
+    def assertQueriesIndependentOfRows(self, client, url, add_rows):
+        # Warms up the role and version caches.
+        client.get(url)
+        add_rows(self.rows)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        add_rows(self.rows)
+        with self.assertNumQueries(len(queries)):
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_course_students(self):
+        def add_rows(n):
+            for _ in range(n):
+                self.course.students.add(
+                    self.make_student(self.next_name('student')))
+        response = self.assertQueriesIndependentOfRows(self.client_of(self.instructor.user),
+                                                       '/api/course/{}/students/'.format(self.course.uid), add_rows)
+        self.assertEqual(len(response.json()), 2 * self.rows + 1)
+
+    def test_course_instructors(self):
+        def add_rows(n):
+            for _ in range(n):
+                self.course.instructor.add(
+                    self.make_instructor(self.next_name('instr')))
+        response = self.assertQueriesIndependentOfRows(self.client_of(self.student.user),
+                                                       '/api/course/{}/instructor/'.format(self.course.uid), add_rows)
+        self.assertEqual(len(response.json()), 2 * self.rows + 1)
+
+    def test_student_courses(self):
+        def add_rows(n):
+            for _ in range(n):
+                course = self.make_course(self.next_name('CS'))
+                course.instructor.add(self.instructor)
+                course.students.add(self.student)
+        response = self.assertQueriesIndependentOfRows(self.client_of(self.student.user),
+                                                       '/api/student/{}/course/'.format(self.student.user.uid), add_rows)
+        self.assertEqual(len(response.json()), 2 * self.rows + 1)
+
+    def test_submission_history(self):
+        def add_rows(n):
+            for _ in range(n):
+                self.make_record(self.assignment, self.student,
+                                 self.created)
+                self.created += 1
+        response = self.assertQueriesIndependentOfRows(self.client_of(self.student.user),
+                                                       '/api/student/{}/course/{}/assignment/{}/history/'.format(
+                                                           self.student.user.uid, self.course.uid, self.assignment.uid),
+                                                       add_rows)
+        self.assertEqual(len(response.json()), 2 * self.rows)
+
+    def test_student_assignments(self):
+        # Thousands of records of the student in other courses, which the
+        # list must not read.
+        def add_rows(n):
+            for _ in range(n):
+                course = self.make_course(self.next_name('CS'))
+                course.students.add(self.student)
+                self.make_records(self.make_assignment(course), self.student, 200)
+        self.make_records(self.assignment, self.student, 30)
+        self.make_records(self.assignment, self.student, 10, state=1)
+        ungraded = self.make_assignment(self.course)
+        client = self.client_of(self.student.user)
+        url = '/api/student/{}/course/{}/assignment/'.format(self.student.user.uid, self.course.uid)
+        response = self.assertQueriesIndependentOfRows(client, url, add_rows)
+        with CaptureQueriesContext(connection) as queries:
+            client.get(url)
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if 'oj_database_record' in query['sql']]), 1)
+        scores = {i['uid']: i['score'] for i in response.json()}
+        # The latest judged record, not the later pending ones.
+        self.assertEqual(scores, {str(self.assignment.uid): 29, str(ungraded.uid): 0})
+
+
+@skipUnless(connection.vendor == 'mysql', 'EXPLAIN output is MySQL specific')
+@override_settings(CACHES=LOCMEM_CACHES)
+class IndexUsageTests(Fixtures, TestCase):
+
+    '''
+    The hot record reads are planned on the indexes of the
+    `0001_record_hot_path_indexes` migration.
+    '''
+    state_indexes = {'ojbn_record_assignment_state_id',
+                     'ojbn_record_assignment_state_gradetime'}
+
+    def setUp(self):
+        cache.clear()
+        self.student = self.make_student('student')
+        self.course = self.make_course('SI100C')
+        self.course.students.add(self.student)
+        # Enough records in other assignments and states that a scan of the
+        # assignment's records by its foreign key alone is not the best plan.
+        self.assignments = [self.make_assignment(self.course) for _ in range(10)]
+        for assignment in self.assignments:
+            self.make_records(assignment, self.student, 30, state=2)
+            self.make_records(assignment, self.student, 30, state=1)
+
+    def explain(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def test_fold(self):
+        for watermark in (None, timezone.now().isoformat()):
+            sql, params = judged_since(self.assignments[0].uid, watermark).query.sql_with_params()
+            keys = {row['key'] for row in self.explain(sql, params)}
+            self.assertTrue(keys & self.state_indexes, keys)
+
+    def test_assignment_list(self):
+        client = APIClient()
+        client.force_authenticate(self.student.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/student/{}/course/{}/assignment/'.format(
+                self.student.user.uid, self.course.uid))
+        self.assertEqual(response.status_code, 200)
+        sql = [query['sql'] for query in queries.captured_queries
+               if 'oj_database_record' in query['sql']]
+        self.assertEqual(len(sql), 1)
+        plan = self.explain(sql[0])
+        possible = set()
+        for row in plan:
+            possible.update((row['possible_keys'] or '').split(','))
+        self.assertTrue(possible & self.state_indexes, possible)
+        self.assertTrue({row['key'] for row in plan} & (self.state_indexes | {
+            'ojbn_record_student_student_record'}), plan)
+
+
+@skipUnless(connection.vendor == 'mysql', 'IGNORE INDEX is MySQL specific')
+class IndexBenchmarkTests(Fixtures, TestCase):
+
+    '''
+    Small scale `manage.py benchmark_indexes`: no hot record query is planned
+    to examine more rows with the indexes than without them.
+    '''
+
+    def setUp(self):
+        self.student = self.make_student('student')
+        course = self.make_course('SI100C')
+        course.students.add(self.student)
+        self.assignments = [self.make_assignment(course) for _ in range(10)]
+        other = self.make_student('other')
+        for assignment in self.assignments:
+            self.make_records(assignment, self.student, 20, state=2)
+            self.make_records(assignment, self.student, 20, state=1)
+            self.make_records(assignment, other, 40, state=2)
+
+    def test_hot_queries(self):
+        for name, queryset in hot_queries(self.assignments[0], self.student).items():
+            (rows, _), (rows_before, _) = measure(queryset, repeat=1)
+            self.assertLessEqual(rows, rows_before, name)
+            if name == 'scoreboard fold':
+                # Judged records alone, instead of all of the assignment's.
+                self.assertLess(rows, rows_before, name)
+
+
+class PaginationTests(Fixtures, TestCase):
+
+    '''
+    Keyset pagination of real records, including records sharing a
+    submission time, which the id orders.
+    '''
+
+    def setUp(self):
+        self.student = self.make_student('student')
+        self.course = self.make_course('SI100C')
+        self.assignment = self.make_assignment(self.course)
+        other = self.make_assignment(self.course)
+        start = timezone.make_aware(datetime(2018, 11, 1))
+        for i in range(7):
+            record = self.make_record(self.assignment, self.student, i)
+            record.submission_time = start + timedelta(minutes=i // 2)
+            record.save()
+        # Not listed: another assignment's record.
+        self.make_record(other, self.student, 7)
+        self.records = self.student.record_set.filter(
+            assignment=self.assignment)
+        self.expected = list(self.records.order_by(
+            '-submission_time', '-id').values_list('id', flat=True))
+
+    def test_cursor_round_trip(self):
+        submission_time = timezone.make_aware(datetime(2018, 11, 1, 8, 30))
+        self.assertEqual(decode_cursor(encode_cursor(
+            submission_time, 42)), (submission_time, 42))
+
+    def test_malformed_cursor(self):
+        for cursor in ('not a cursor', 'bm90IGEgY3Vyc29y', encode_cursor(timezone.now(), 1)[:-4]):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_pages(self):
+        seen = []
+        cursor = None
+        pages = 0
+        while True:
+            rows, cursor = records_page(
+                self.records, cursor, 3, ['commit_tag'], {'record': F('id')})
+            self.assertEqual(set(rows[0]), {'commit_tag', 'record'})
+            seen.extend(row['record'] for row in rows)
+            pages += 1
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, self.expected)
+
+    def test_last_page_has_no_cursor(self):
+        rows, cursor = records_page(self.records, None, 7, ['id'], {})
+        self.assertEqual([row['id'] for row in rows], self.expected)
+        self.assertIsNone(cursor)
+
+
+class ETagTests(SimpleTestCase):
+
+    etag = 'W/"0123abcd"'
+
+    def request(self, if_none_match=None):
+        headers = {'HTTP_IF_NONE_MATCH': if_none_match} if if_none_match else {}
+        return RequestFactory().get('/api/course/', **headers)
+
+    def test_matching_tag(self):
+        response = not_modified(self.request(self.etag), self.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], self.etag)
+
+    def test_weak_comparison(self):
+        self.assertEqual(not_modified(self.request(
+            '"0123abcd"'), self.etag).status_code, 304)
+        self.assertEqual(not_modified(self.request(
+            '"ffff", W/"0123abcd"'), self.etag).status_code, 304)
+
+    def test_any_tag(self):
+        self.assertEqual(not_modified(
+            self.request('*'), self.etag).status_code, 304)
+
+    def test_not_matching(self):
+        self.assertIsNone(not_modified(self.request(), self.etag))
+        self.assertIsNone(not_modified(
+            self.request('W/"ffff"'), self.etag))
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_bump_changes_tag(self):
+        course_uid = uuid1()
+        etag = course_etag([course_uid], '/api/course/')
+        self.assertEqual(course_etag([course_uid], '/api/course/'), etag)
+        self.assertNotEqual(course_etag([course_uid], '/api/other/'), etag)
+        bump_course_version(course_uid)
+        self.assertNotEqual(course_etag([course_uid], '/api/course/'), etag)
+
+
+class FakeSubmission(queue_policy.Submission):
+
+    def __init__(self, receive_time, student_ids=(1,), pending=0, recent=0, deadline=None):
+        super().__init__(1, deadline, list(student_ids), 1, receive_time)
+        self.pending = pending
+        self.recent = recent
+
+    def pending_count(self):
+        return self.pending
+
+    def recent_count(self, since):
+        return self.recent
+
+
+class QueuePolicyTests(SimpleTestCase):
+
+    def setUp(self):
+        self.now = timezone.make_aware(datetime(2018, 11, 1, 12))
+        self.base = int(self.now.timestamp())
+
+    def test_first_in_first_out(self):
+        self.assertEqual(queue_policy.score(
+            FakeSubmission(self.now, pending=3), []), self.base)
+
+    def test_fair_share(self):
+        self.assertEqual(queue_policy.score(FakeSubmission(self.now, pending=3), [queue_policy.fair_share]),
+                         self.base + 3 * queue_policy.FAIR_SHARE_DELAY)
+        self.assertEqual(queue_policy.score(FakeSubmission(self.now, student_ids=(), pending=3),
+                                            [queue_policy.fair_share]), self.base)
+
+    def test_resubmission(self):
+        self.assertEqual(queue_policy.score(FakeSubmission(self.now, recent=2), [queue_policy.resubmission]),
+                         self.base + 2 * queue_policy.RESUBMISSION_DELAY)
+
+    def test_deadline(self):
+        policies = [queue_policy.deadline]
+        self.assertEqual(queue_policy.score(FakeSubmission(
+            self.now, deadline=self.now + timedelta(hours=1)), policies), self.base)
+        self.assertEqual(queue_policy.score(FakeSubmission(self.now, deadline=self.now - timedelta(hours=1)),
+                                            policies), self.base + queue_policy.LATE_DELAY)
+
+    def test_get_policies(self):
+        self.assertEqual(queue_policy.get_policies(' fair_share, deadline,'), [
+                         queue_policy.fair_share, queue_policy.deadline])
+        with self.assertRaises(KeyError):
+            queue_policy.get_policies('shortest_first')
+
+    def test_replay_first_in_first_out(self):
+        # One judge taking 10s: the third push waits for the two before it.
+        waits = replay([(0, 'a'), (1, 'a'), (2, 'b')], [],
+                       judges=1, judge_seconds=10)
+        self.assertEqual(waits, {'a': [0, 9], 'b': [18]})
+
+    def test_replay_fair_share(self):
+        # The second push of `a` is delayed behind the first push of `b`.
+        waits = replay([(0, 'a'), (1, 'a'), (2, 'b')], [queue_policy.fair_share],
+                       judges=1, judge_seconds=10)
+        self.assertEqual(waits, {'a': [0, 19], 'b': [8]})
+
+
+class JudgeQueueEncodingTests(SimpleTestCase):
+
+    payload = {'upstream': 'git@oj.geekpie.club/si100c-17f/hw1-diaozh.git',
+               'owner_uids': ['a', 'b'], 'receive_time': 1541030400, 'record_id': 42}
+
+    def test_compact_entry(self):
+        with mock.patch.object(judge_queue, 'OJBN_QUEUE_ENCODING', 'compact'):
+            self.assertEqual(judge_queue.encode_entry(
+                self.payload), ('42', '1541030400|a,b'))
+
+    def test_json_entry(self):
+        with mock.patch.object(judge_queue, 'OJBN_QUEUE_ENCODING', 'json'):
+            entry, meta = judge_queue.encode_entry(self.payload)
+        self.assertEqual(simplejson.loads(entry), self.payload)
+        self.assertIsNone(meta)
+
+    def test_decode_both_encodings(self):
+        raw = [simplejson.dumps(self.payload).encode(), b'43', b'44']
+        self.assertEqual(judge_queue.pending_meta_fields(raw), ['43', '44'])
+        pending = judge_queue.decode_pending(
+            raw, [b'1541030460|c', None])
+        self.assertEqual(pending[0], self.payload)
+        self.assertEqual(pending[1], {'record_id': 43, 'receive_time': 1541030460,
+                                      'owner_uids': ['c']})
+        # Metadata lost to expiry still decodes.
+        self.assertEqual(pending[2], {'record_id': 44, 'receive_time': None,
+                                      'owner_uids': []})
+
+
+
+class ScoreboardKeyTests(SimpleTestCase):
+
+    course = uuid1()
+    assignment = uuid1()
+
+    def test_uid_forms_share_keys(self):
+        for key in ('_board_key', '_meta_key', '_seen_key', '_lock_key', '_fresh_key'):
+            helper = getattr(scoreboard, key)
+            self.assertEqual(helper(str(self.assignment)), helper(self.assignment.hex))
+        self.assertEqual(scoreboard._ranking_key(str(self.course), str(self.assignment), 'w'),
+                         scoreboard._ranking_key(self.course.hex, self.assignment.hex, 'w'))
+
+    def test_drop_either_form(self):
+        with mock.patch.object(scoreboard, 'get_redis') as get_redis:
+            scoreboard.drop_scoreboard(str(self.assignment))
+            scoreboard.drop_scoreboard(self.assignment.hex)
+        first, second = get_redis.return_value.delete.call_args_list
+        self.assertEqual(first, second)
+
+
+class AsyncSubmissionInterfaceTests(SimpleTestCase):
+
+    '''
+    The async submission interface takes the bodies the sync one parses.
+    '''
+    push = {'assignment_uid': 'b3b17c00f16511e8b3dfdca9047a0f14',
+            'upstream': 'git@git.oj.geekpie.club/si100c-17f/hw1-diaozh.git',
+            'additional_data': '["diaozh"]'}
+
+    def post(self, request):
+        request.META['HTTP_AUTHORIZATION'] = async_views.OJ_SUBMISSION_TOKEN
+        view = async_views.asyncInternalSubmissionInterface.as_view()
+        with mock.patch.object(async_views, 'get_redis'), \
+                mock.patch.object(async_views, 'ingest_submission') as ingest:
+            response = async_to_sync(view)(request)
+        return response, ingest
+
+    def test_json(self):
+        response, ingest = self.post(RequestFactory().post(
+            '/api/internal/submission/', simplejson.dumps(self.push), content_type='application/json'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ingest.call_args[0][1], self.push)
+
+    def test_form(self):
+        for content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+            factory = RequestFactory()
+            if content_type == 'multipart/form-data':
+                request = factory.post('/api/internal/submission/', self.push)
+            else:
+                request = factory.post('/api/internal/submission/', urlencode(
+                    self.push), content_type=content_type)
+            response, ingest = self.post(request)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(ingest.call_args[0][1], self.push)
+
+    def test_malformed(self):
+        for body in ('not json', '[]'):
+            response, ingest = self.post(RequestFactory().post(
+                '/api/internal/submission/', body, content_type='application/json'))
+            self.assertEqual(response.status_code, 400)
+            ingest.assert_not_called()
@@ -16,9 +16,18 @@
 # under the License.
 
 from django.urls import path, include
+from oj_backend.settings import OJBN_SERVER_MODE
 from .views import *
+from .metrics import metrics_exposition
+
+if OJBN_SERVER_MODE == 'asgi':
+    from .async_views import asyncPendingAssignment as pendingAssignment
+    from .async_views import asyncInternalSubmissionInterface as internalSubmissionInterface
+    from .async_views import asyncAssignmentScoreboardDetail as assignmentScoreboardDetail
+    from .async_views import asyncAssignmentScoreboardDetail4Student as assignmentScoreboardDetail4Student
 
 urlpatterns = [
+    path('metrics', metrics_exposition),
     path('user/', userRole.as_view()),
     path('user/role', userRole.as_view()),
     path('user/<str:uid>/student', userStudent.as_view()),
@@ -44,7 +53,10 @@ urlpatterns = [
     path('course/<str:uid>/instructor/', courseInstrList.as_view()),
     path('course/<str:course_id>/instructor/<str:instr_email>',
          courseInstrDetail.as_view()),
+    path('course/<str:course_id>/provisioning', courseProvisioning.as_view()),
     path('course/<str:course_id>/students/', courseStudentList.as_view()),
+    path('course/<str:course_id>/students/bulk', courseStudentBulkEnrol.as_view()),
+    path('course/<str:course_id>/students/bulk/<str:job_id>', courseStudentBulkEnrolJob.as_view()),
     path('course/<str:course_id>/students/<str:student_email>',
          courseStudentDetail.as_view()),
     path('course/<str:course_id>/judge/', courseJudgeList.as_view()),
@@ -57,9 +69,16 @@ urlpatterns = [
     path('course/<str:course_id>/assignment/<str:assignment_id>/scores/',
          assignmentScoreboardDetail.as_view()),
     path('course/<str:course_id>/assignment/<str:assignment_id>/queue', pendingAssignment.as_view()),
+    path('course/<str:course_id>/assignment/<str:assignment_id>/queue/mode', pendingAssignmentMode.as_view()),
     path('course/<str:course_id>/assignment/<str:assignment_id>/export', assignmentSubmissionExportation.as_view()),
     path('judge/', instrJudgeList.as_view()),
     path('judge/<str:uid>', instrJudgeDetail.as_view()),
     path('internal/submission/', internalSubmissionInterface.as_view()),
     path('internal/submission', internalSubmissionInterface.as_view())
 ]
+
+if OJBN_SERVER_MODE == 'asgi':
+    # An open stream would hold a sync worker for its whole duration.
+    from .async_views import asyncPendingAssignmentStream
+    urlpatterns.append(path('course/<str:course_id>/assignment/<str:assignment_id>/queue/stream',
+                            asyncPendingAssignmentStream.as_view()))
@@ -23,6 +23,7 @@ from oj_database.models import Student
 from oj_database.models import Instructor
 from oj_backend.backend.middleware_connector import *
 from oj_backend.backend.celery_tasks import *
+from oj_backend.backend.roles import invalidate_user_roles
 from oidc_rp.signals import oidc_user_created
 
 auth_logger = logging.getLogger('backend.main')
@@ -50,11 +51,11 @@ def oidc_create_user_callback(request, oidc_user, **kwargs):
             'User {} already exists in git server. Skipped. It is probabaly becuase this user is already added as a student or instructor in a course on the server.')
     this_student, _ = generate_student_for_user(user, claims)
     generate_instructor_for_user(user, claims)
+    invalidate_user_roles(user)
     if this_student:
-        for course in this_student.course_set.all():
-            for assignment in course.assignment_set.all():
-                MWCourseAddRepoDelay.delay(course.uid, assignment.uid, this_student.enroll_email,
-                                           str(assignment.deadline.date()), owner_uid=simplejson.dumps([str(user.uid)]))
+        provision_repos([repo_for(course.uid, assignment, this_student.enroll_email, user.uid)
+                         for course in this_student.course_set.all()
+                         for assignment in course.assignment_set.all()])
 
 
 oidc_user_created.connect(oidc_create_user_callback,
@@ -75,11 +76,11 @@ def oidc_user_update_handler(oidc_user, claims):
     user.save()
     this_student, _ = generate_student_for_user(user, claims)
     generate_instructor_for_user(user, claims)
+    invalidate_user_roles(user)
     if user.email != claims.get('email'):
-        for course in this_student.course_set.all():
-            for assignment in course.assignment_set.all():
-                MWCourseAddRepoDelay.delay(course.uid, assignment.uid, this_student.enroll_email,
-                                           str(assignment.deadline.date()), owner_uid=simplejson.dumps([str(user.uid)]))
+        provision_repos([repo_for(course.uid, assignment, this_student.enroll_email, user.uid)
+                         for course in this_student.course_set.all()
+                         for assignment in course.assignment_set.all()])
 
 
 def generate_student_for_user(user, claims):
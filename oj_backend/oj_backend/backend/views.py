@@ -16,9 +16,9 @@
 # under the License.
 from datetime import datetime
 from django.views import View
-from django.db.models import Max, F, Q
-from django.db.models.expressions import RawSQL
-from django.db import connection
+from django.db import transaction
+from django.db.models import Max, F, Q, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.core.validators import validate_email, validate_ipv46_address
 from django.http import HttpResponse, JsonResponse, HttpResponseNotAllowed, Http404, HttpResponse, HttpResponseForbidden
@@ -37,7 +37,8 @@ try:
 except:
     import simplejson
 
-import redis
+import io
+import csv
 import time
 import logging
 from uuid import uuid1, UUID
@@ -47,9 +48,15 @@ from oj_backend.backend.utils import student_active_test, student_test, insturct
 from oj_backend.backend.models import *
 from oj_backend.backend.serializers import *
 from oj_backend.backend.permissions import *
-from oj_backend.settings import redisConnectionPool, OJ_SUBMISSION_TOKEN, OJ_ENFORCE_HTTPS
+from oj_backend.settings import OJ_SUBMISSION_TOKEN, OJ_ENFORCE_HTTPS
+from oj_backend.backend.redis_client import get_redis, get_pipeline
 from oj_backend.backend.middleware_connector import *
 from oj_backend.backend.celery_tasks import *
+from oj_backend.backend.judge_queue import ingest_submission, parse_page, read_pending, resolve_nicknames, format_pending, is_latest_only, set_latest_only, forget_assignment_info
+from oj_backend.backend.roles import get_course_role, invalidate_course_role, invalidate_course_roles
+from oj_backend.backend.etags import course_etag, bump_course_version, not_modified
+from oj_backend.backend.pagination import parse_limit, records_page
+from oj_backend.backend.scoreboard import get_ranking, project_instructor, project_public, drop_scoreboard
 
 backend_logger = logging.getLogger('backend.main')
 
@@ -223,7 +230,7 @@ class courseList4Students(generics.GenericAPIView, mixins.ListModelMixin):
     def get_queryset(self):
         this_student = get_object_or_404(Student.objects.filter(
             user=self.request.user), user__uid=self.kwargs['uid'])
-        return this_student.course_set.all()
+        return this_student.course_set.prefetch_related('instructor')
 
     def get(self, request, *args, **kwargs):
         try:
@@ -232,7 +239,12 @@ class courseList4Students(generics.GenericAPIView, mixins.ListModelMixin):
             return JsonResponse(data={'cuase': 'Bad request'}, status=400)
         if request.user.uid != uid:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
-        return self.list(request, *args, **kwargs)
+        etag = course_etag(Course.objects.filter(
+            students__user=request.user).values_list('uid', flat=True), request.path)
+        response = not_modified(request, etag) or self.list(
+            request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
 
 
 class courseList4Instr(generics.GenericAPIView, mixins.ListModelMixin, mixins.CreateModelMixin):
@@ -245,7 +257,7 @@ class courseList4Instr(generics.GenericAPIView, mixins.ListModelMixin, mixins.Cr
     def get_queryset(self):
         this_instr = get_object_or_404(Instructor.objects.filter(
             user=self.request.user), user__uid=self.kwargs['uid'])
-        return this_instr.course_set.all()
+        return this_instr.course_set.prefetch_related('instructor')
 
     def perform_create(self, serializer):
         serializer.save(creator=self.request.user.uid, uid=uuid1())
@@ -263,27 +275,46 @@ class courseList4Instr(generics.GenericAPIView, mixins.ListModelMixin, mixins.Cr
         response = self.create(request, *args, **kwargs)
         this_course = Course.objects.get(uid=response.data['uid'])
         this_course.instructor.add(request.user.instructor)
-        try:
-            course_name = get_course_project_name(
-                this_course.code, this_course.year, this_course.semester)
-            MWUpdateCourse(course_name, str(this_course.uid))
-        except (MiddlewareError, MWUpdateError):
-            # rollback.
-            this_course.delete()
-            return JsonResponse(status=500, data={"cuase": "Git server error."})
-        for instr in this_course.instructor.all():
-            if not MW_if_user_exists(instr.enroll_email):
-                try:
-                    MWUpdateUser(instr.enroll_email)
-                except (MiddlewareError, MWUpdateError):
-                    return JsonResponse(data={'cause': 'Git server error.'}, status=500)
-            try:
-                MWCourseAddInstr(this_course.uid, instr.enroll_email)
-            except (MiddlewareError, MWUpdateError):
-                return JsonResponse(data={'cause': 'Git server error.'}, status=500)
+        invalidate_course_role(this_course.uid, request.user)
+        # The git server is updated in the background; its progress is at
+        # `/course/<str:course_id>/provisioning`.
+        start_course_provisioning(this_course)
+        response.data['provisioning'] = COURSE_PROVISION_PENDING
         return response
 
 
+def start_course_provisioning(this_course):
+    course_name = get_course_project_name(
+        this_course.code, this_course.year, this_course.semester)
+    set_course_provision_state(this_course.uid, COURSE_PROVISION_PENDING)
+    MWCourseProvisionDelay.delay(str(this_course.uid), course_name, list(
+        this_course.instructor.values_list('enroll_email', flat=True)))
+
+
+class courseProvisioning(generics.GenericAPIView):
+    '''
+    `/course/<str:course_id>/provisioning`
+    '''
+    permission_classes = (IsAuthenticated, )
+
+    def get(self, request, *args, **kwargs):
+        role = get_course_role(request, self.kwargs['course_id'])
+        if not role.is_instructor:
+            return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        state = get_course_provision_state(role.course_uid)
+        state['failed_repos'] = get_repo_failures(role.course_uid)
+        return JsonResponse(data=state, status=200)
+
+    def post(self, request, *args, **kwargs):
+        role = get_course_role(request, self.kwargs['course_id'])
+        if not role.is_instructor:
+            return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        if get_course_provision_state(role.course_uid)['state'] not in (COURSE_PROVISION_FAILED, COURSE_PROVISION_UNKNOWN):
+            return JsonResponse(data={'cause': 'Only a failed provisioning can be retried.'}, status=409)
+        start_course_provisioning(role.course)
+        return JsonResponse(data={'state': COURSE_PROVISION_PENDING, 'cause': ''}, status=202)
+
+
 class assignmentList4Student(generics.GenericAPIView):
     '''
     `/student/<str:student_id>/course/<str:course_id>/assignment/`
@@ -294,44 +325,13 @@ class assignmentList4Student(generics.GenericAPIView):
             Student, user__uid=self.kwargs['student_id'])
         this_course = get_object_or_404(
             this_student.course_set.all(), uid=self.kwargs['course_id'])
-        this_assignment_set = this_course.assignment_set.all()
-
-        BASE = """
-            SELECT
-                max(`oj_database_record`.`id`)
-            FROM
-                oj_database_student
-            INNER JOIN `oj_database_record_student` ON `oj_database_record_student`.`student_id` = `oj_database_student`.`id`
-            INNER JOIN `oj_database_record` ON `oj_database_record_student`.`record_id` = `oj_database_record`.`id`
-            WHERE
-                `oj_database_student`.`id` = {id}
-            AND `oj_database_record`.`state` = 2
-            GROUP BY
-                `oj_database_record`.`assignment_id`
-        """
-        SQL = BASE.format(
-            id=this_student.id
-        )
-        with connection.cursor() as cursor:
-            cursor.execute(SQL)
-            recids = [i[0]for i in cursor.fetchall()]
-
-        last_rec = Record.objects.filter(id__in=recids)
-        last_rec = {i['assignment_id']: i['grade']
-                    for i in list(last_rec.values())}
-        assignment_with_grade = list(this_assignment_set.values
-                                     ('uid', 'course_id', 'name', 'descr_link', 'deadline',
-                                      'release_date', 'deadline', 'short_name', overall_score=F('grade')))
-        for i in range(len(assignment_with_grade)):
-            try:
-                assignment_with_grade[i]['score'] = last_rec[assignment_with_grade[i]['uid']]
-            except KeyError:
-                assignment_with_grade[i]['score'] = 0
-
-        assignment_with_grade = sorted(
-            assignment_with_grade,
-            key=lambda x: (x["deadline"], x["release_date"], x["name"])
-        )
+        # The grade of the latest judged record of this student, per assignment.
+        latest_grade = Record.objects.filter(
+            assignment=OuterRef('pk'), student=this_student, state=2).order_by('-id').values('grade')[:1]
+        assignment_with_grade = list(this_course.assignment_set.annotate(
+            score=Coalesce(Subquery(latest_grade), 0)).order_by('deadline', 'release_date', 'name').values(
+            'uid', 'course_id', 'name', 'descr_link', 'deadline', 'release_date', 'short_name', 'score',
+            overall_score=F('grade')))
 
         return JsonResponse(assignment_with_grade, safe=False)
 
@@ -345,21 +345,28 @@ class courseInformation(generics.GenericAPIView, mixins.RetrieveModelMixin, mixi
     queryset = Course.objects.all()
 
     def get_object(self):
-        course_uid = self.kwargs['uid']
-        queryset = self.get_queryset()
-        obj = get_object_or_404(
-            queryset, uid=course_uid)
+        obj = get_course_role(self.request, self.kwargs['uid']).course
         self.check_object_permissions(self.request, obj)
         return obj
 
     def get(self, request, *args, **kwargs):
-        return self.retrieve(request, *args, **kwargs)
+        if not get_course_role(request, self.kwargs['uid']).is_member:
+            return self.retrieve(request, *args, **kwargs)
+        etag = course_etag([self.kwargs['uid']], request.path)
+        response = not_modified(request, etag) or self.retrieve(
+            request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
 
     def post(self, request, *args, **kwargs):
-        return self.update(request, *args, **kwargs)
+        response = self.update(request, *args, **kwargs)
+        bump_course_version(self.kwargs['uid'])
+        return response
 
     def delete(self, request, *args, **kwargs):
-        return self.destroy(request, *args, **kwargs)
+        response = self.destroy(request, *args, **kwargs)
+        bump_course_version(self.kwargs['uid'])
+        return response
 
 
 class assignmentList4Instr(generics.GenericAPIView, mixins.ListModelMixin, mixins.CreateModelMixin):
@@ -370,21 +377,35 @@ class assignmentList4Instr(generics.GenericAPIView, mixins.ListModelMixin, mixin
     permission_classes = (assignmentInfoReadWritePermisson, IsAuthenticated)
 
     def get_queryset(self):
-        this_course = get_object_or_404(Course, uid=self.kwargs['uid'])
+        this_course = get_course_role(self.request, self.kwargs['uid']).course
         return this_course.assignment_set.all().order_by("deadline", "release_date", "name")
 
     def perform_create(self, serializer):
-        this_course = get_object_or_404(Course, uid=self.kwargs['uid'])
+        this_course = get_course_role(self.request, self.kwargs['uid']).course
         serializer.save(course=this_course)
 
     def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
+        etag = course_etag([self.kwargs['uid']], request.path)
+        response = not_modified(request, etag) or self.list(
+            request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
 
     def post(self, request, *args, **kwargs):
-        this_course = get_object_or_404(Course, uid=self.kwargs['uid'])
-        if not this_course.instructor.filter(user=request.user):
+        this_role = get_course_role(request, self.kwargs['uid'])
+        if not this_role.is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        this_course = this_role.course
+        # The assignment is created under the course on the git server.
+        provision_state = get_course_provision_state(this_course.uid)['state']
+        if provision_state == COURSE_PROVISION_UNKNOWN:
+            start_course_provisioning(this_course)
+            provision_state = COURSE_PROVISION_PENDING
+        if provision_state != COURSE_PROVISION_READY:
+            return JsonResponse(data={'cause': 'The course is not ready on the git server yet.',
+                                      'provisioning': provision_state}, status=409)
         response = self.create(request, *args, **kwargs)
+        bump_course_version(this_course.uid)
         this_assignment = Assignment.objects.get(uid=response.data['uid'])
         deadline = this_assignment.deadline
         try:
@@ -397,15 +418,14 @@ class assignmentList4Instr(generics.GenericAPIView, mixins.ListModelMixin, mixin
             this_assignment.save()
         except (MiddlewareError, MWUpdateError):
             this_assignment.delete()
+            bump_course_version(this_course.uid)
             return JsonResponse(data={"cuase": "Git server error."}, status=500)
         if isinstance(response, Response):
             response.data['ssh_url_to_repo'] = git_repo
             response.content = simplejson.dumps(response.data)
         try:
-            for student in this_course.students.all():
-                if student.user:
-                    MWCourseAddRepoDelay.delay(this_course.uid, this_assignment.uid,
-                                    student.enroll_email, str(deadline.date()), owner_uid=simplejson.dumps([str(student.user.uid)]))
+            provision_repos([repo_for(this_course.uid, this_assignment, student.enroll_email, student.user_id)
+                             for student in this_course.students.exclude(user=None)])
         except:
             return JsonResponse(status=500, data={})
         return response
@@ -419,7 +439,7 @@ class assignmentDetail(generics.GenericAPIView, mixins.RetrieveModelMixin, mixin
     permission_classes = (assignmentInfoReadWritePermisson, IsAuthenticated)
 
     def get_queryset(self):
-        this_course = get_object_or_404(Course, uid=self.kwargs['course_id'])
+        this_course = get_course_role(self.request, self.kwargs['course_id']).course
         return this_course.assignment_set.all()
 
     def get_object(self):
@@ -430,17 +450,28 @@ class assignmentDetail(generics.GenericAPIView, mixins.RetrieveModelMixin, mixin
         return obj
 
     def get(self, request, *args, **kwargs):
-        return self.retrieve(request, *args, **kwargs)
+        etag = course_etag([self.kwargs['course_id']], request.path)
+        response = not_modified(request, etag) or self.retrieve(
+            request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
 
     def post(self, request, *args, **kwargs):
-        return self.update(request, *args, **kwargs)
+        response = self.update(request, *args, **kwargs)
+        bump_course_version(self.kwargs['course_id'])
+        forget_assignment_info(self.kwargs['assignment_id'])
+        return response
 
     def delete(self, request, *args, **kwargs):
-        this_course = Course.objects.get(uid=self.kwargs['course_id'])
+        this_course = get_course_role(request, self.kwargs['course_id']).course
         this_assignment = Assignment.objects.get(
             uid=self.kwargs['assignment_id'])
         MWCourseDelAssignment(this_course.uid, this_assignment.uid)
-        return self.destroy(request, *args, **kwargs)
+        response = self.destroy(request, *args, **kwargs)
+        bump_course_version(this_course.uid)
+        drop_scoreboard(this_assignment.uid)
+        forget_assignment_info(this_assignment.uid)
+        return response
 
 
 class courseInstrList(generics.GenericAPIView, mixins.ListModelMixin, mixins.CreateModelMixin):
@@ -451,18 +482,19 @@ class courseInstrList(generics.GenericAPIView, mixins.ListModelMixin, mixins.Cre
     permission_classes = (courseInstrInfoReadWritePermission, IsAuthenticated)
 
     def get_queryset(self):
-        this_course = get_object_or_404(Course, uid=self.kwargs['uid'])
-        return this_course.instructor.all()
+        this_course = get_course_role(self.request, self.kwargs['uid']).course
+        return this_course.instructor.select_related('user')
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
-        this_course = Course.objects.get(uid=self.kwargs['uid'])
         if not request.user.is_authenticated:
             return JsonResponse(data={'cause': 'Unauthorized'}, status=401)
-        if not this_course.instructor.filter(user__uid=request.user.uid).exists():
+        this_role = get_course_role(request, self.kwargs['uid'])
+        if not this_role.is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        this_course = this_role.course
         try:
             enroll_email = request.data['enroll_email']
         except KeyError:
@@ -485,6 +517,8 @@ class courseInstrList(generics.GenericAPIView, mixins.ListModelMixin, mixins.Cre
                 pass
         this_instr.save()
         this_course.instructor.add(this_instr)
+        invalidate_course_role(this_course.uid, this_instr.user)
+        bump_course_version(this_course.uid)
         try:
             MWCourseAddInstr(
                 course_uid=self.kwargs['uid'], instr_email=request.data['enroll_email'])
@@ -503,8 +537,8 @@ class courseInstrDetail(generics.GenericAPIView, mixins.RetrieveModelMixin, mixi
     permission_classes = (courseInstrInfoReadWritePermission, IsAuthenticated)
 
     def get_queryset(self):
-        this_course = get_object_or_404(Course, uid=self.kwargs['course_id'])
-        return this_course.instructor.all()
+        this_course = get_course_role(self.request, self.kwargs['course_id']).course
+        return this_course.instructor.select_related('user')
 
     def get_object(self):
         obj = get_object_or_404(self.get_queryset(),
@@ -516,9 +550,10 @@ class courseInstrDetail(generics.GenericAPIView, mixins.RetrieveModelMixin, mixi
         return self.retrieve(request, *args, **kwargs)
 
     def delete(self, request, *args, **kwargs):
-        this_course = Course.objects.get(uid=self.kwargs['course_id'])
-        if not this_course.instructor.filter(user__uid=request.user.uid).exists():
+        this_role = get_course_role(request, self.kwargs['course_id'])
+        if not this_role.is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        this_course = this_role.course
         try:
             this_instr = this_course.instructor.get(
                 enroll_email=self.kwargs['instr_email'])
@@ -528,6 +563,8 @@ class courseInstrDetail(generics.GenericAPIView, mixins.RetrieveModelMixin, mixi
             if this_instr.user.uid == UUID(this_course.creator):
                 return JsonResponse(data={'cause': "You could not delete creator from a course's instructor list."}, status=400)
         this_course.instructor.remove(this_instr)
+        invalidate_course_role(this_course.uid, this_instr.user)
+        bump_course_version(this_course.uid)
         return HttpResponse(content='', status=204)
 
 
@@ -540,15 +577,16 @@ class courseStudentList(generics.GenericAPIView, mixins.ListModelMixin):
         courseStudentInfoReadWritePermission, IsAuthenticated)
 
     def get_queryset(self):
-        return get_object_or_404(Course, uid=self.kwargs['course_id']).students.all()
+        return get_course_role(self.request, self.kwargs['course_id']).course.students.select_related('user')
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
-        this_course = Course.objects.get(uid=self.kwargs['course_id'])
-        if not this_course.instructor.filter(user__uid=request.user.uid).exists():
+        this_role = get_course_role(request, self.kwargs['course_id'])
+        if not this_role.is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        this_course = this_role.course
         try:
             enroll_email = request.data['enroll_email']
             student_id = request.data['student_id']
@@ -572,13 +610,92 @@ class courseStudentList(generics.GenericAPIView, mixins.ListModelMixin):
             this_student.save()
             MWUpdateUser(enroll_email)
         this_course.students.add(this_student)
+        invalidate_course_role(this_course.uid, this_student.user)
+        bump_course_version(this_course.uid)
         if this_student.user:
-            for assignment in this_course.assignment_set.all():
-                MWCourseAddRepoDelay.delay(self.kwargs['course_id'], assignment.uid, enroll_email,
-                                str(assignment.deadline.date()), owner_uid=simplejson.dumps([str(this_student.user.uid)]))
+            provision_repos([repo_for(this_course.uid, assignment, enroll_email, this_student.user.uid)
+                             for assignment in this_course.assignment_set.all()])
         return JsonResponse(data=StudentBasicInfoSerializer(this_student).data, status=201, safe=False)
 
 
+class courseStudentBulkEnrol(generics.GenericAPIView):
+    '''
+    `/course/<str:course_id>/students/bulk`
+
+    Enrols many students at once. Accepts a JSON array of objects with
+    `enroll_email` and `student_id`, or a CSV with the same header, either
+    uploaded as `file` or posted as `text/csv`. The git server is updated by
+    a background job whose progress is at `/course/<str:course_id>/students/bulk/<str:job_id>`.
+    '''
+    permission_classes = (
+        courseStudentInfoReadWritePermission, IsAuthenticated)
+
+    def get_rows(self, request):
+        if request.content_type.startswith('text/csv'):
+            return list(csv.DictReader(io.StringIO(request.body.decode('utf-8-sig'))))
+        if 'file' in request.FILES:
+            return list(csv.DictReader(io.StringIO(request.FILES['file'].read().decode('utf-8-sig'))))
+        if isinstance(request.data, list):
+            return request.data
+        raise ValueError('Expecting a JSON array or a CSV file.')
+
+    def post(self, request, *args, **kwargs):
+        this_course = get_course_role(request, self.kwargs['course_id']).course
+        try:
+            rows = self.get_rows(request)
+        except (ValueError, UnicodeDecodeError, csv.Error):
+            return JsonResponse(data={'cause': 'Bad request'}, status=400)
+        student_ids = {}
+        invalid = []
+        for row in rows:
+            try:
+                enroll_email = row['enroll_email'].strip()
+                validate_email(enroll_email)
+            except (KeyError, TypeError, AttributeError, ValidationError):
+                invalid.append(row)
+                continue
+            student_ids[enroll_email] = row.get('student_id') or ''
+
+        with transaction.atomic():
+            students = {i.enroll_email: i for i in Student.objects.filter(
+                enroll_email__in=student_ids.keys())}
+            new_emails = [i for i in student_ids if i not in students]
+            users = {i.email: i for i in User.objects.filter(
+                email__in=new_emails)}
+            Student.objects.bulk_create([Student(enroll_email=i, user=users.get(i), student_id=student_ids[i])
+                                         for i in new_emails])
+            # MySQL does not return the primary keys of bulk created rows.
+            students.update({i.enroll_email: i for i in Student.objects.filter(
+                enroll_email__in=new_emails)})
+            this_course.students.add(*students.values())
+        invalidate_course_roles(
+            this_course.uid, [i.user_id for i in students.values()])
+        bump_course_version(this_course.uid)
+
+        linked = [i for i in students.values() if i.user_id]
+        repos = [repo_for(this_course.uid, assignment, student.enroll_email, student.user_id)
+                 for assignment in this_course.assignment_set.all() for student in linked]
+        job_id = uuid1().hex
+        create_enrol_job(job_id, this_course.uid, len(new_emails))
+        MWCourseBulkEnrolDelay.delay(job_id, new_emails, repos)
+        return JsonResponse(data={'job_id': job_id, 'enrolled': len(students), 'created': len(new_emails), 'invalid': invalid}, status=202)
+
+
+class courseStudentBulkEnrolJob(generics.GenericAPIView):
+    '''
+    `/course/<str:course_id>/students/bulk/<str:job_id>`
+    '''
+    permission_classes = (
+        courseStudentInfoReadWritePermission, IsAuthenticated)
+
+    def get(self, request, *args, **kwargs):
+        this_job = get_enrol_job(self.kwargs['job_id'])
+        if not this_job or this_job['course_uid'] != get_course_role(request, self.kwargs['course_id']).course_uid:
+            return JsonResponse(data={'cause': 'Not found'}, status=404)
+        this_job['job_id'] = self.kwargs['job_id']
+        return JsonResponse(data=this_job, status=200)
+
+
 class courseStudentDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
     '''
     `/course/<str:course_id>/student/<str:student_email>`
@@ -589,7 +706,7 @@ class courseStudentDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
         courseStudentInfoReadWritePermission, IsAuthenticated)
 
     def get_queryset(self):
-        return get_object_or_404(Course, uid=self.kwargs['course_id']).students.all()
+        return get_course_role(self.request, self.kwargs['course_id']).course.students.select_related('user')
 
     def get_object(self):
         queryset = self.get_queryset()
@@ -602,15 +719,18 @@ class courseStudentDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
         return self.retrieve(request, *args, **kwargs)
 
     def delete(self, request, *args, **kwargs):
-        this_course = Course.objects.get(uid=self.kwargs['course_id'])
-        if not this_course.instructor.filter(user__uid=request.user.uid).exists():
+        this_role = get_course_role(request, self.kwargs['course_id'])
+        if not this_role.is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        this_course = this_role.course
         try:
             this_student = this_course.students.get(
                 enroll_email=self.kwargs['student_email'])
         except:
             return JsonResponse(data={'cause': 'Not found'}, status=404)
         this_course.students.remove(this_student)
+        invalidate_course_role(this_course.uid, this_student.user)
+        bump_course_version(this_course.uid)
         if this_student.user:
             for assignment in this_course.assignment_set.all():
                 MWCourseDelRepoDelay.delay(this_course.uid, assignment.uid,
@@ -626,7 +746,7 @@ class courseJudgeList(generics.GenericAPIView, mixins.ListModelMixin, mixins.Cre
     permission_classes = (courseJudgeReadWritePermisson, IsAuthenticated)
 
     def get_queryset(self):
-        return get_object_or_404(Course, uid=self.kwargs['course_id']).default_judge.all()
+        return get_course_role(self.request, self.kwargs['course_id']).course.default_judge.all()
 
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
@@ -640,13 +760,12 @@ class courseJudgeList(generics.GenericAPIView, mixins.ListModelMixin, mixins.Cre
         if not maintiainer == request.user:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
         try:
-            this_course = Course.objects.get(uid=self.kwargs['course_id'])
-        except:
+            this_role = get_course_role(request, self.kwargs['course_id'])
+        except Http404:
             return JsonResponse(data={'cause': 'Not Found'}, status=404)
-        try:
-            this_course.instructor.get(user__uid=request.user.uid)
-        except:
+        if not this_role.is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        this_course = this_role.course
         this_course.default_judge.add(this_judge)
         return JsonResponse(JudgeSerializer(this_judge).data, safe=False, status=201)
 
@@ -659,7 +778,7 @@ class courseJudgeDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
     permission_classes = (courseJudgeReadWritePermisson, IsAuthenticated)
 
     def get_queryset(self):
-        return get_object_or_404(Course, uid=self.kwargs['course_id']).default_judge.all()
+        return get_course_role(self.request, self.kwargs['course_id']).course.default_judge.all()
 
     def get_object(self):
         obj = get_object_or_404(self.get_queryset(),
@@ -672,13 +791,12 @@ class courseJudgeDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
 
     def delete(self, request, *args, **kwargs):
         try:
-            this_course = Course.objects.get(uid=self.kwargs['course_id'])
-        except:
+            this_role = get_course_role(request, self.kwargs['course_id'])
+        except Http404:
             return JsonResponse(data={'cause': 'Not Found'}, status=404)
-        try:
-            this_course.instructor.get(user__uid=request.user.uid)
-        except:
+        if not this_role.is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
+        this_course = this_role.course
         this_judge = get_object_or_404(
             Judge.objects.all(), uid=self.kwargs['judge_id'])
         this_course.default_judge.remove(this_judge)
@@ -716,7 +834,7 @@ class assignmentJudgeList(generics.GenericAPIView, mixins.ListModelMixin):
         except:
             return JsonResponse(data={''}, status=404)
 
-        if not this_assignment.course.instructor.filter(user__uid=request.user.uid).exists():
+        if not get_course_role(request, this_assignment.course_id).is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
 
         if (not this_assignment.course.default_judge.filter(uid=this_judge.uid).exists()) and \
@@ -724,7 +842,7 @@ class assignmentJudgeList(generics.GenericAPIView, mixins.ListModelMixin):
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
 
         this_assignment.judge.add(this_judge)
-        this_redis = redis.Redis(connection_pool=redisConnectionPool)
+        this_redis = get_redis()
         backend_logger.info(
             'Published redis data to assignment_judge: {}'.format(request.data['uid']))
         this_redis.publish('assignment_judge', request.data['uid'])
@@ -757,15 +875,13 @@ class assignmentJudgeDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
                 uid=self.kwargs['assignment_id'], course__uid=self.kwargs['course_id'])
         except:
             return JsonResponse(data={'cause': 'Not found'}, status=404)
-        try:
-            this_assignment.course.instructor.get(user__uid=request.user.uid)
-        except:
+        if not get_course_role(request, this_assignment.course_id).is_instructor:
             return JsonResponse(data={'cause': 'Forbidden'}, status=403)
         this_judge = Judge.objects.get(uid=self.kwargs['judge_id'])
         this_assignment.judge.reomve(this_judge)
         backend_logger.info(
             'Published redis data to assignment_judge: {}'.format(request.data['uid']))
-        this_redis = redis.Redis(connection_pool=redisConnectionPool)
+        this_redis = get_redis()
         this_redis.publish('assignment_judge', request.data['uid'])
         return HttpResponse(content='', status=204)
 
@@ -773,19 +889,53 @@ class assignmentJudgeDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
 class submissionHistoryList(generics.GenericAPIView, mixins.ListModelMixin):
     '''
     `/student/<str:student_id>/course/<str:course_id>/assignment/<str:assignment_id>/history/`
+
+    Paged newest first by the `cursor` and `limit` query parameters; the
+    cursor of the next page is given in the `X-Next-Cursor` header. `fields`
+    selects a comma separated subset of the fields, which leaves out
+    `message` by default.
     '''
     serializer_class = SubmissionRecordSerializer
     permission_classes = (submissionRecordReadPermission, IsAuthenticated)
+    page_size = 50
+    max_page_size = 200
+    model_fields = ('state', 'commit_tag', 'message',
+                    'submission_time', 'delta')
+    renamed_fields = {'score': F('grade'), 'overall_score': F(
+        'assignment__grade'), 'assignment_id': F('assignment__uid')}
+    default_fields = ('state', 'commit_tag', 'score', 'overall_score',
+                      'assignment_id', 'submission_time', 'delta')
 
     def get_queryset(self):
         this_student = get_object_or_404(
             Student, user__uid=self.kwargs['student_id'])
         this_assignment = get_object_or_404(
             Assignment, uid=self.kwargs['assignment_id'], course__uid=self.kwargs['course_id'])
-        return this_student.record_set.filter(assignment=this_assignment).order_by('-submission_time')
+        return this_student.record_set.filter(assignment=this_assignment)
+
+    def get_fields(self, request):
+        if 'fields' not in request.GET:
+            return self.default_fields
+        fields = [i for i in request.GET['fields'].split(',') if i]
+        for i in fields:
+            if i not in self.model_fields and i not in self.renamed_fields:
+                raise ValueError('Unknown field {}.'.format(i))
+        return fields
 
     def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
+        try:
+            fields = self.get_fields(request)
+            limit = parse_limit(
+                request.GET, self.page_size, self.max_page_size)
+            records, next_cursor = records_page(self.get_queryset(), request.GET.get('cursor'), limit,
+                                                [i for i in fields if i in self.model_fields],
+                                                {i: self.renamed_fields[i] for i in fields if i in self.renamed_fields})
+        except ValueError:
+            return JsonResponse(data={'cause': 'Bad request'}, status=400)
+        response = JsonResponse(records, status=200, safe=False)
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
 
 
 class submissionHistoryDetail(generics.GenericAPIView, mixins.RetrieveModelMixin):
@@ -869,111 +1019,71 @@ class assignmentScoreboardDetail(generics.GenericAPIView):
         courseStudentInfoReadWritePermission, IsAuthenticated)
 
     def get(self, request, *args, **kwargs):
-        this_course = self.kwargs['course_id']
-        this_assignment = self.kwargs['assignment_id']
-        this_course_student_list = get_object_or_404(Course, uid=this_course).students.all(
-        ).values("id", "user_id", "nickname", "user__name", "student_id")
-
-        BASE = """
-        SELECT
-            `odu`.`uid`,
-            `ods`.`nickname`,
-            `odu`.`name`,
-            `ods`.`student_id`,
-            `odr`.`grade`,
-            `odr`.`delta`,
-            `odr`.`submission_time`,
-            `lastest_records`.`count`
-        FROM
-            `oj_database_student` `ods`
-        INNER JOIN `oj_database_user` `odu` ON `ods`.`user_id` = `odu`.`uid`
-        INNER JOIN `oj_database_record_student` `odrs` ON `odrs`.`student_id` = `ods`.`id`
-        INNER JOIN `oj_database_record` `odr` ON `odrs`.`record_id` = `odr`.`id`
-        INNER JOIN (
-            SELECT
-                MAX(`odr`.`id`) AS `id`,
-                count(*) AS `count`
-            FROM
-                `oj_database_student` `ods`
-            INNER JOIN `oj_database_record_student` `odrs` ON `odrs`.`student_id` = `ods`.`id`
-            INNER JOIN `oj_database_record` `odr` ON `odrs`.`record_id` = `odr`.`id`
-            WHERE
-                `odr`.`assignment_id` = '{assignment_id}'
-            AND `odr`.`state` = 2
-            GROUP BY
-                `ods`.`id`
-        ) `lastest_records` ON `lastest_records`.`id` = `odr`.`id`
-        WHERE
-            `odr`.`assignment_id` = '{assignment_id}'
-        ORDER BY
-            `grade` DESC,
-            `submission_time` ASC,
-            `count` ASC;
-        """
-        SQL = BASE.format(
-            assignment_id=this_assignment.replace("-", "")
-        )
-        with connection.cursor() as cursor:
-            cursor.execute(SQL)
-            res = cursor.fetchall()
-
-        backend_logger.info('Searching scoreboard for: {}; last_rec: {}'.format(
-                this_assignment, str(res)))
-        oscore = get_object_or_404(Assignment,uid=this_assignment).grade
-
-        student_with_grade = []
-        stu_set=set()
-        for i in res:
-            stu_set.add(i[0])
-            student_with_grade.append({
-                'nickname': i[1],
-                "name": i[2],
-                "student_id": i[3],
-                'overall_score': oscore,
-                'score': i[4],
-                'delta': i[5],
-                'submission_time': timezone.make_aware(i[6]),
-                'submission_count': i[7]
-            })
-
-        for i in this_course_student_list:
-            if str(i['user_id']).replace("-","") not in stu_set:
-                student_with_grade.append({
-                    'nickname': i['nickname'],
-                    "name": i["user__name"],
-                    "student_id": i["student_id"],
-                    'overall_score': oscore,
-                    'score': 0,
-                    'delta': None,
-                    'submission_time': None,
-                    'submission_count': 0
-                })
-        return JsonResponse(student_with_grade, safe=False)
+        ranking = get_ranking(self.kwargs['course_id'], self.kwargs['assignment_id'])
+        return JsonResponse(project_instructor(ranking), safe=False)
 
 
 class pendingAssignment(generics.GenericAPIView, mixins.ListModelMixin):
     '''
     `/course/<str:course_id>/assignment/<str:assignment_id>/queue/`
+
+    Paged by the `offset` and `limit` query parameters. The total length of
+    the queue is given in the `X-Total-Count` header.
     '''
+    page_size = 100
+    max_page_size = 500
 
     def get(self, request, course_id, assignment_id):
         if not request.user.is_authenticated:
             return Response(data={}, status=401)
-        this_course = get_object_or_404(Course, uid=course_id)
-        if not (this_course.instructor.filter(user__uid=request.user.uid).exists() or this_course.students.filter(user__uid=request.user.uid).exists()):
+        if not get_course_role(request, course_id).is_member:
             return Response(data={}, status=403)
-        redis_server = redis.Redis(
-            connection_pool=redisConnectionPool)
-        all_pending = redis_server.zrange(assignment_id, 0, -1)
-        pending_list = []
-        for submission in all_pending:
-            submission = simplejson.loads(submission)
-            display_submission = {}
-            display_submission['submission_time'] = submission['receive_time']
-            display_submission['submitter'] = ', '.join(Student.objects.get(
-                user__uid=submitter).nickname for submitter in submission['owner_uids'])
-            pending_list.append(display_submission)
-        return JsonResponse(pending_list, status=200, safe=False)
+        try:
+            offset, limit = parse_page(
+                request.GET, self.page_size, self.max_page_size)
+        except ValueError:
+            return JsonResponse(data={'cause': 'Bad request'}, status=400)
+        redis_server = get_redis()
+        pipe = get_pipeline(redis_server)
+        pipe.zrange(assignment_id, offset, offset + limit - 1)
+        pipe.zcard(assignment_id)
+        all_pending, total = pipe.execute()
+        all_pending = read_pending(redis_server, assignment_id, all_pending)
+        pending_list = format_pending(
+            all_pending, resolve_nicknames(all_pending))
+        response = JsonResponse(pending_list, status=200, safe=False)
+        response['X-Total-Count'] = total
+        return response
+
+
+class pendingAssignmentMode(generics.GenericAPIView):
+    '''
+    `/course/<str:course_id>/assignment/<str:assignment_id>/queue/mode`
+    '''
+    permission_classes = (IsAuthenticated, )
+
+    def get_assignment(self, request):
+        this_role = get_course_role(request, self.kwargs['course_id'])
+        if not this_role.is_instructor:
+            raise PermissionDenied
+        return get_object_or_404(Assignment, uid=self.kwargs['assignment_id'], course__uid=this_role.course_uid)
+
+    def get(self, request, *args, **kwargs):
+        this_assignment = self.get_assignment(request)
+        redis_server = get_redis()
+        return JsonResponse(data={'latest_only': is_latest_only(redis_server, this_assignment.uid)}, status=200)
+
+    def post(self, request, *args, **kwargs):
+        this_assignment = self.get_assignment(request)
+        try:
+            latest_only = request.data['latest_only']
+        except (KeyError, TypeError):
+            return JsonResponse(data={'cause': 'Bad request'}, status=400)
+        if not isinstance(latest_only, bool):
+            return JsonResponse(data={'cause': 'Bad request'}, status=400)
+        redis_server = get_redis()
+        set_latest_only(redis_server, this_assignment.uid, latest_only)
+        return JsonResponse(data={'latest_only': latest_only}, status=200)
 
 
 class internalSubmissionInterface(generics.GenericAPIView):
@@ -989,51 +1099,12 @@ class internalSubmissionInterface(generics.GenericAPIView):
             backend_logger.error('Submission interface recieved an unauthorized submission. Token: {}; From {}; Payload: {}'.format(
                 auth_token, remote, request.data))
             return JsonResponse(status=401, data={'cause': 'Invalid token.'})
-        this_submission = simplejson.dumps(request.data)
-        this_redis = redis.Redis(connection_pool=redisConnectionPool)
-        now = int(time.time())
+        this_redis = get_redis()
         try:
-            upstream = request.data['upstream']
-            try:
-                owner_uids = simplejson.loads(
-                    request.data['additional_data'])
-            except:
-                owner_uids = None
-            assignment_uid = request.data["assignment_uid"]
+            ingest_submission(this_redis, request.data)
         except KeyError:
             return JsonResponse(data={'cause': 'Missing parameter in request'}, status=400)
-        if isinstance(owner_uids, str):
-            owner_uids = [owner_uids]
-        payload = {'upstream': upstream,
-                   "owner_uids": owner_uids, 'receive_time': now}
-        if upstream.endswith("_grading_script.git"):
-            # The upstream stores the grading script.
-            payload = simplejson.dumps(payload)
-            channel = "grade_script_pushed"
-            backend_logger.info('Submission relied. Payload: {}; Channel: {}'.format(
-                payload, channel))
-            this_redis.publish(channel, payload)
-        else:
-            # The upstream stores the student's submission.
-            R = Record(assignment=Assignment.objects.get(uid=assignment_uid),
-                       grade=0,
-                       delta=0,
-                       grade_time=timezone.make_aware(
-                           datetime.fromtimestamp(0)),
-                       submission_time=timezone.make_aware(
-                           datetime.fromtimestamp(now)),
-                       redis_message=simplejson.dumps(payload),
-                       state=1)
-            R.save()
-            stuSet = Student.objects.filter(user__in=owner_uids)
-            R.student.add(*stuSet)
-            channel = assignment_uid
-            payload['record_id'] = R.id
-            payload = simplejson.dumps(payload)
-            backend_logger.info('Submission relied. Payload: {}; Channel: {}; Weight: {}'.format(
-                payload, channel, now))
-            this_redis.zadd(channel, {payload: now})
-        return Response(data=simplejson.loads(this_submission), status=201)
+        return Response(data=request.data, status=201)
 
 
 class OIDCLoginParam(generics.GenericAPIView):
@@ -1057,82 +1128,8 @@ class assignmentScoreboardDetail4Student(generics.GenericAPIView):
     '''
 
     def get(self, request, *args, **kwargs):
-        this_course = self.kwargs['course_id']
-        this_assignment = self.kwargs['assignment_id']
-        this_course_student_list = get_object_or_404(
-            Course, uid=this_course).students.all().values("id", "user_id", "nickname")
-
-        BASE = """
-        SELECT
-            `odu`.`uid`,
-            `ods`.`nickname`,
-            `odu`.`name`,
-            `ods`.`student_id`,
-            `odr`.`grade`,
-            `odr`.`delta`,
-            `odr`.`submission_time`,
-            `lastest_records`.`count`
-        FROM
-            `oj_database_student` `ods`
-        INNER JOIN `oj_database_user` `odu` ON `ods`.`user_id` = `odu`.`uid`
-        INNER JOIN `oj_database_record_student` `odrs` ON `odrs`.`student_id` = `ods`.`id`
-        INNER JOIN `oj_database_record` `odr` ON `odrs`.`record_id` = `odr`.`id`
-        INNER JOIN (
-            SELECT
-                MAX(`odr`.`id`) AS `id`,
-                count(*) AS `count`
-            FROM
-                `oj_database_student` `ods`
-            INNER JOIN `oj_database_record_student` `odrs` ON `odrs`.`student_id` = `ods`.`id`
-            INNER JOIN `oj_database_record` `odr` ON `odrs`.`record_id` = `odr`.`id`
-            WHERE
-                `odr`.`assignment_id` = '{assignment_id}'
-            AND `odr`.`state` = 2
-            GROUP BY
-                `ods`.`id`
-        ) `lastest_records` ON `lastest_records`.`id` = `odr`.`id`
-        WHERE
-            `odr`.`assignment_id` = '{assignment_id}'
-        ORDER BY
-            `grade` DESC,
-            `submission_time` ASC,
-            `count` ASC;
-        """
-        SQL = BASE.format(
-            assignment_id=this_assignment.replace("-", "")
-        )
-        with connection.cursor() as cursor:
-            cursor.execute(SQL)
-            res = cursor.fetchall()
-
-        backend_logger.info('Searching scoreboard for: {}; last_rec: {}'.format(
-                this_assignment, str(res)))
-        oscore = get_object_or_404(Assignment,uid=this_assignment).grade
-
-        student_with_grade = []
-        stu_set=set()
-        for i in res:
-            stu_set.add(i[0])
-            student_with_grade.append({
-                'nickname': i[1],
-                'overall_score': oscore,
-                'score': i[4],
-                'delta': i[5],
-                'submission_time': timezone.make_aware(i[6]),
-                'submission_count': i[7]
-            })
-
-        for i in this_course_student_list:
-            if str(i['user_id']).replace("-","") not in stu_set:
-                student_with_grade.append({
-                    'nickname': i['nickname'],
-                    'overall_score': oscore,
-                    'score': 0,
-                    'delta': None,
-                    'submission_time': None,
-                    'submission_count': 0
-                })
-        return JsonResponse(student_with_grade, safe=False)
+        ranking = get_ranking(self.kwargs['course_id'], self.kwargs['assignment_id'])
+        return JsonResponse(project_public(ranking), safe=False)
 
 
 class assignmentSubmissionExportation(generics.GenericAPIView):
@@ -1165,11 +1162,12 @@ class assignmentSubmissionExportation(generics.GenericAPIView):
 
         if not request.user.is_authenticated:
             return Response(data={}, status=401)
-        this_course = get_object_or_404(Course, uid=course_id)
-        if not this_course.instructor.filter(user__uid=request.user.uid).exists():
+        this_role = get_course_role(request, course_id)
+        if not this_role.is_instructor:
             return Response(data={}, status=403)
+        this_course = this_role.course
 
-        all_students = get_object_or_404(Course, uid=course_id).students.all()
+        all_students = this_course.students.all()
         this_assignment = get_object_or_404(
             Assignment, uid=assignment_id, course__uid=course_id)
         script = self.script_header
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 ericdiao <hi@ericdiao.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Restores the Django APIs `django-oidc-rp` 0.3.4, its last release, still
+uses and Django 4 removed. Imported by the settings, before the apps load.
+
+Every alias is only set when missing, so this does nothing on a Django that
+still has them, and can go once `oidc_rp` is replaced.
+"""
+
+import django.conf.urls
+import django.dispatch
+import django.utils.encoding
+import django.utils.http
+import django.utils.translation
+from django.http import HttpRequest
+from django.urls import re_path
+
+
+def _is_ajax(self):
+    return self.headers.get('x-requested-with') == 'XMLHttpRequest'
+
+
+def _is_safe_url(url, allowed_hosts, require_https=False):
+    return django.utils.http.url_has_allowed_host_and_scheme(url, allowed_hosts, require_https)
+
+
+class _Signal(django.dispatch.Signal):
+
+    '''
+    `Signal` still accepting the documentation-only `providing_args`.
+    '''
+
+    def __init__(self, providing_args=None, use_caching=False):
+        super().__init__(use_caching=use_caching)
+
+
+def install():
+    if not hasattr(django.conf.urls, 'url'):
+        django.conf.urls.url = re_path
+    if not hasattr(django.utils.translation, 'ugettext_lazy'):
+        django.utils.translation.ugettext_lazy = django.utils.translation.gettext_lazy
+    if not hasattr(django.utils.encoding, 'smart_text'):
+        django.utils.encoding.smart_text = django.utils.encoding.smart_str
+    if not hasattr(django.utils.http, 'is_safe_url'):
+        django.utils.http.is_safe_url = _is_safe_url
+    if not hasattr(HttpRequest, 'is_ajax'):
+        HttpRequest.is_ajax = _is_ajax
+    try:
+        django.dispatch.Signal(providing_args=[])
+    except TypeError:
+        django.dispatch.Signal = _Signal
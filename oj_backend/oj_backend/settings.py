@@ -28,8 +28,13 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
-import redis
 from django.urls import reverse
+from oj_backend import oidc_compat
+from oj_backend.backend.instrumentation import InstrumentedConnection, InstrumentedAsyncConnection
+from oj_backend.backend.redis_client import make_connection_pool, make_async_connection_pool
+
+# `oidc_rp` is imported by the apps and the URLs after the settings.
+oidc_compat.install()
 
 LOGGING = {
     'version': 1,
@@ -95,6 +100,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'oj_backend.backend.instrumentation.RequestMetricsMiddleware',
+    'oj_backend.backend.metrics.PrometheusMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -127,6 +134,11 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'oj_backend.wsgi.application'
+ASGI_APPLICATION = 'oj_backend.asgi.application'
+
+# `wsgi` or `asgi`. In ASGI mode, the I/O bound views are served by their
+# async variants in `backend/async_views.py`.
+OJBN_SERVER_MODE = os.environ.get('OJBN_SERVER_MODE', 'wsgi').lower()
 
 
 # Database
@@ -140,6 +152,11 @@ DATABASES = {
         'PASSWORD': os.environ['OJBN_DB_PASSWD'],
         'HOST': os.environ['OJBN_DB_HOST'],
         'PORT': '3306',
+        # Keep connections open across requests so they are not re-established
+        # on every request. Statements are still parsed per call. Not in ASGI
+        # mode, where the ORM runs in `sync_to_async` threads that would each
+        # keep their own connection open.
+        'CONN_MAX_AGE': 0 if OJBN_SERVER_MODE == 'asgi' else int(os.environ.get('OJBN_DB_CONN_MAX_AGE', 60)),
     }
 }
 
@@ -150,12 +167,16 @@ CACHES = {
         "LOCATION": os.environ['OJBN_REDIS_ADDR'],
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "CONNECTION_POOL_KWARGS": {"connection_class": InstrumentedConnection},
         }
     }
 }
 
-redisConnectionPool = redis.ConnectionPool(
-    connection_class=redis.Connection, max_connections=100, host=os.environ['OJBN_REDIS_HOST'], port=int(os.environ['OJBN_REDIS_PORT']), db=int(os.environ['OJBN_REDIS_DB']))
+redisConnectionPool = make_connection_pool(
+    connection_class=InstrumentedConnection, host=os.environ['OJBN_REDIS_HOST'], port=int(os.environ['OJBN_REDIS_PORT']), db=int(os.environ['OJBN_REDIS_DB']))
+# Used by the async views in ASGI mode.
+asyncRedisConnectionPool = make_async_connection_pool(
+    connection_class=InstrumentedAsyncConnection, host=os.environ['OJBN_REDIS_HOST'], port=int(os.environ['OJBN_REDIS_PORT']), db=int(os.environ['OJBN_REDIS_DB']))
 
 
 # Password validation